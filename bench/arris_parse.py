@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Benchmark Arris status page parsing, BeautifulSoup vs htmltables
+
+Parses saved RgConnect.asp/RgSwInfo.asp pages the way arris-modem.py used
+to (full BeautifulSoup tree, findAll and str() on every <th>) and the way it
+does now (streaming htmltables.TableExtractor), and reports the time per
+parse and the peak RSS of each. Every parser runs in its own forked child so
+the RSS figures don't bleed into each other.
+
+usage: bench/arris_parse.py [-n ITERATIONS] [PAGE ...]
+
+Pages default to the captures in bench/data/arris/. BeautifulSoup 3 is only
+needed to measure the old path; it's skipped when it isn't installed.
+"""
+
+import glob
+import optparse
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from collectors.lib import htmltables
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    'data', 'arris')
+
+WANTED = {'downstream': 'Downstream', 'upstream': 'Upstream',
+          'swinfo': 'Status'}
+
+
+def parse_soup(page):
+    from BeautifulSoup import BeautifulSoup
+    rows = dict((name, []) for name in WANTED)
+    soup = BeautifulSoup(page)
+    for table in soup.findAll('table'):
+        for header in table.findAll('th'):
+            for name, keyword in WANTED.iteritems():
+                if keyword in str(header):
+                    for row in table.findAll('tr'):
+                        rows[name].append([ele.text.strip() for ele in
+                                           row.findAll('td')])
+    return rows
+
+
+def parse_stream(page, chunk_size=8192):
+    tables = htmltables.TableExtractor(WANTED)
+    for i in xrange(0, len(page), chunk_size):
+        tables.feed(page[i:i + chunk_size])
+    tables.close()
+    return tables.rows
+
+
+def run(parser, pages, iterations):
+    """Runs parser over every page in a child, returns (secs/parse,
+    peak RSS in KB), or None if the child failed.
+    """
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            starttime = time.time()
+            for _ in xrange(iterations):
+                for page in pages:
+                    parser(page)
+            elapsed = time.time() - starttime
+            os.write(wfd, "%r" % (elapsed / (iterations * len(pages))))
+        except Exception, e:
+            print >> sys.stderr, "%s failed: %s" % (parser.__name__, e)
+        os._exit(0)
+
+    os.close(wfd)
+    result = os.read(rfd, 128)
+    os.close(rfd)
+    _, _, usage = os.wait4(pid, 0)
+    if not result:
+        return None
+    return float(result), usage.ru_maxrss
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [-n ITERATIONS] [PAGE ...]")
+    parser.add_option("-n", "--iterations", type="int", default=200,
+                      help="times to parse each page (default: %default)")
+    options, args = parser.parse_args()
+
+    paths = args or sorted(glob.glob(os.path.join(DATA, '*.asp')))
+    pages = [open(path).read() for path in paths]
+    if not pages:
+        parser.error("no pages to parse")
+
+    # Baseline RSS of a child that parses nothing
+    idle = run(lambda page: None, pages, 1)
+
+    print "%d pages, %d iterations, idle child peak RSS %d KB" % (
+        len(pages), options.iterations, idle[1])
+    print "%-14s %12s %14s" % ("parser", "ms/parse", "peak RSS KB")
+    for name, func in (("beautifulsoup", parse_soup),
+                       ("htmltables", parse_stream)):
+        result = run(func, pages, options.iterations)
+        if result is None:
+            print "%-14s %12s %14s" % (name, "-", "-")
+            continue
+        secs, rss = result
+        print "%-14s %12.3f %14d" % (name, secs * 1000, rss)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Microbenchmark for collectors/lib/emitter.py
+
+Emits POINTS data points per cycle, spread over a fixed set of series with
+a couple of tags each, and reports the time per cycle for:
+
+    print        the old way, "%s %d %s %s" % (...) and a tag join per
+                 point, printed one at a time, stdout flushed per cycle
+    emit         Emitter.emit() with a tags dict, one write per cycle
+    emit_series  Emitter.emit_series() with held Series handles
+    emit_fd      emit_series() with the Emitter writing straight to an fd
+
+Output goes to /dev/null.
+
+usage: bench/emitter.py [-p POINTS] [-c CYCLES] [-s SERIES]
+"""
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from collectors.lib import emitter
+
+
+def bench_print(out, names, tags, points, ts):
+    stdout = sys.stdout
+    sys.stdout = out
+    try:
+        nseries = len(names)
+        for i in xrange(points):
+            n = i % nseries
+            all_tags = " ".join("%s=%s" % (name, value)
+                                for name, value in tags[n].iteritems())
+            print "%s %d %s %s" % (names[n], ts, i, all_tags)
+        sys.stdout.flush()
+    finally:
+        sys.stdout = stdout
+
+
+def bench_emit(out, names, tags, points, ts):
+    nseries = len(names)
+    for i in xrange(points):
+        n = i % nseries
+        out.emit(names[n], ts, i, tags[n])
+    out.flush()
+
+
+def bench_emit_series(out, series, points, ts):
+    nseries = len(series)
+    emit_series = out.emit_series
+    for i in xrange(points):
+        emit_series(series[i % nseries], ts, i)
+    out.flush()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [-p POINTS] [-c CYCLES]")
+    parser.add_option("-p", "--points", type="int", default=100000,
+                      help="points per cycle (default: %default)")
+    parser.add_option("-c", "--cycles", type="int", default=10,
+                      help="cycles to time (default: %default)")
+    parser.add_option("-s", "--series", type="int", default=500,
+                      help="distinct series (default: %default)")
+    options, _ = parser.parse_args()
+
+    names = ["bench.metric%d" % (n % 20) for n in xrange(options.series)]
+    tags = [{'device': 'sd%d' % n, 'host': 'bench'}
+            for n in xrange(options.series)]
+
+    devnull = open(os.devnull, 'w')
+    stream_out = emitter.Emitter(stream=devnull)
+    fd_out = emitter.Emitter(fd=devnull.fileno())
+    stream_series = [stream_out.series(name, tag)
+                     for name, tag in zip(names, tags)]
+    fd_series = [fd_out.series(name, tag) for name, tag in zip(names, tags)]
+
+    cases = [
+        ('print', lambda ts: bench_print(devnull, names, tags,
+                                         options.points, ts)),
+        ('emit', lambda ts: bench_emit(stream_out, names, tags,
+                                       options.points, ts)),
+        ('emit_series', lambda ts: bench_emit_series(stream_out,
+                                                     stream_series,
+                                                     options.points, ts)),
+        ('emit_fd', lambda ts: bench_emit_series(fd_out, fd_series,
+                                                 options.points, ts)),
+    ]
+
+    print "%d points/cycle over %d series, %d cycles" % (
+        options.points, options.series, options.cycles)
+    print "%-12s %12s %14s" % ("case", "ms/cycle", "points/sec")
+    for name, func in cases:
+        times = []
+        for cycle in xrange(options.cycles):
+            starttime = time.time()
+            func(1500000000 + cycle)
+            times.append(time.time() - starttime)
+        best = min(times)
+        print "%-12s %12.1f %14d" % (name, best * 1000,
+                                     options.points / best)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Replay saved device output through every collector
+
+Loads each collector from collectors/0 with its device access swapped for
+the captures in bench/data/ (or canned sensor readings), then times its
+collect() and flush to /dev/null, cycle after cycle:
+
+    arris-modem         RgConnect.asp/RgSwInfo.asp, streamed in 8K chunks
+    smartctl_stat       one disk per smartctl capture
+    smartlinc_imeter    buffstatus.xml per iMeter, two controllers
+    chef-server         knife stats JSON and RabbitMQ queue list
+    dht_temp            sensors from collectors/etc/dht.conf, stub reads
+    get-bme280          SAMPLES stub reads drained per cycle
+    ina219_power        three stub modules, SAMPLES reads each
+
+Each collector runs in its own forked child, so its threads, memory and
+module state don't leak into the next. For each one this reports the
+points per cycle, cycle latency percentiles, points/sec, and allocations:
+peak traced KB when tracemalloc is available, otherwise the growth in
+gc-tracked objects per cycle, plus the child's peak RSS either way.
+
+usage: bench/replay.py [-n CYCLES] [-v] [COLLECTOR ...]
+"""
+
+import gc
+import glob
+import imp
+import json
+import math
+import optparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from collectors.lib import emitter
+from collectors.lib import httpclient
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DATA = os.path.join(ROOT, 'bench', 'data')
+COLLECTORS = os.path.join(ROOT, 'collectors', '0')
+
+# bme280 samples drained per cycle, about a 15s interval at 1Hz
+SAMPLES = 15
+
+
+def read_data(*path):
+    return open(os.path.join(DATA, *path)).read()
+
+
+def load(filename):
+    name = os.path.splitext(filename)[0]
+    return imp.load_source(name, os.path.join(COLLECTORS, filename))
+
+
+def fake_module(name, **attrs):
+    """Installs a stand-in for a hardware library in sys.modules."""
+
+    module = imp.new_module(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    if '.' in name:
+        parent, child = name.rsplit('.', 1)
+        setattr(sys.modules.setdefault(parent, imp.new_module(parent)),
+                child, module)
+    return module
+
+
+def wave(n, base, swing, period=60.0):
+    """A repeatable stand-in for a sensor reading that drifts about."""
+
+    return base + swing * math.sin(n * 2 * math.pi / period)
+
+
+class FakeHTTP(object):
+    """Serves canned bodies by path, the way HTTPClient.get() returns
+    them, streaming them in chunks when asked to.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get(self, host, path, timeout=None, headers=None, stream=None,
+            retry=True):
+        body = self.pages[path]
+        if stream is None:
+            return 200, body
+        for i in xrange(0, len(body), httpclient.CHUNK_SIZE):
+            stream(body[i:i + httpclient.CHUNK_SIZE])
+        return 200, None
+
+    def metrics(self):
+        return iter(())
+
+
+class FakeSmartLinc(object):
+    """Answers iMeter status commands from saved buffstatus.xml captures.
+    Replies to the commands sent since the last buffstatus.xml read are
+    queued up in the response buffer, as the controller does.
+    """
+
+    # SmartLinc response buffers are this many hex digits, zero padded
+    BUFFER_SIZE = 202
+    # the command echo, ACK and extended status reply of one poll
+    REPLY_SIZE = 90
+
+    def __init__(self, captures):
+        self.replies = {}
+        for device, xml in captures.iteritems():
+            frames = xml.split('<BS>', 1)[1].split('</BS>', 1)[0]
+            self.replies[device] = frames[:self.REPLY_SIZE]
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, path, timeout=None, headers=None, stream=None,
+            retry=True):
+        with self.lock:
+            if path.startswith('/3?0262'):
+                device = path[len('/3?0262'):][:6]
+                self.pending.setdefault(host, []).append(device)
+                return 200, ''
+            frames = ''.join(self.replies[device]
+                             for device in self.pending.pop(host, []))
+        return 200, ('<response><BS>%s</BS></response>'
+                     % frames[-self.BUFFER_SIZE:].ljust(self.BUFFER_SIZE,
+                                                       '0'))
+
+    def metrics(self):
+        return iter(())
+
+
+def replay_arris():
+    module = load('arris-modem.py')
+    module.http = FakeHTTP({
+        '/RgConnect.asp': read_data('arris', 'RgConnect.asp'),
+        '/RgSwInfo.asp': read_data('arris', 'RgSwInfo.asp'),
+    })
+    return module
+
+
+def replay_smartctl():
+    module = load('smartctl_stat.py')
+    captures = {}
+    for path in sorted(glob.glob(os.path.join(DATA, 'smartctl', '*'))):
+        name = os.path.basename(path)
+        if name.startswith('standby'):
+            returncode = 2
+        elif name.startswith('no-json'):
+            returncode = 1
+        else:
+            returncode = 0
+        captures['/dev/' + os.path.splitext(name)[0]] = (returncode,
+                                                         open(path).read())
+    module.discover_devices = lambda: sorted(captures)
+    module.run_smartctl = captures.__getitem__
+    return module
+
+
+def replay_smartlinc():
+    module = load('smartlinc_imeter.py')
+    captures = {}
+    for path in sorted(glob.glob(os.path.join(DATA, 'smartlinc',
+                                              'buffstatus-*.xml'))):
+        device = os.path.basename(path)[len('buffstatus-'):-len('.xml')]
+        captures[device] = open(path).read()
+    module.http = FakeSmartLinc(captures)
+    devices = sorted(captures)
+    module.imeters.clear()
+    module.imeters['10.0.0.20'] = devices[:len(devices) // 2]
+    module.imeters['10.0.0.21'] = devices[len(devices) // 2:]
+    return module
+
+
+def replay_chef():
+    module = load('chef-server.py')
+    knife = read_data('chef', 'knife-stats.json')
+    decoder = json.JSONDecoder()
+
+    class FakeWorker(object):
+        def request(self, timeout):
+            return decoder.raw_decode(knife.strip())[0]
+
+    rabbitmq = module.RabbitMQStats('localhost:15672', '/chef', 'guest',
+                                    'guest')
+    rabbitmq.http = FakeHTTP({
+        rabbitmq.path: read_data('chef', 'rabbitmq-queues.json'),
+    })
+    module.worker = FakeWorker()
+    module.backends[:] = [module.Backend(rabbitmq, 0)]
+    module.CHEF_INTERVAL = module.STATS_INTERVAL = 0
+
+    # wait for the knife refresh thread, so each cycle sends the stats
+    # from the one before
+    def collect(out, ts):
+        real_collect(out, ts)
+        module.chef_refresh.join()
+
+    real_collect = module.collect
+    module.collect = collect
+    return module
+
+
+def replay_dht():
+    reads = [0]
+
+    def read(model, gpio):
+        reads[0] += 1
+        return (wave(reads[0], 45, 10), wave(reads[0] + gpio, 21, 3))
+
+    fake_module('Adafruit_DHT', DHT11=11, DHT22=22, AM2302=22, read=read)
+    module = load('dht_temp.py')
+    module.MIN_READ_SPACING = 0
+    module.setup()
+    return module
+
+
+def replay_bme280():
+    class Reading(object):
+        def __init__(self, n):
+            self.temperature = wave(n, 21, 2)
+            self.pressure = wave(n, 1013, 5)
+            self.humidity = wave(n, 45, 10)
+
+    reads = [0]
+
+    def sample(bus, address, calibration_params):
+        reads[0] += 1
+        return Reading(reads[0])
+
+    fake_module('smbus2', SMBus=lambda port: None)
+    fake_module('bme280', load_calibration_params=lambda bus, address: {},
+                sample=sample)
+    module = load('get-bme280.py')
+    sampler = module.sampler
+
+    # what the sampler thread does between cycles, done up front
+    def collect(out, ts):
+        for _ in xrange(SAMPLES):
+            reading = module.read_sensor()
+            with sampler.lock:
+                for field, value in reading.iteritems():
+                    sampler.buffers[field].append(value)
+        real_collect(out, ts)
+
+    real_collect = module.collect
+    module.collect = collect
+    return module
+
+
+def replay_ina219():
+    class INA219(object):
+        def __init__(self, address):
+            self.address = address
+            self.reads = 0
+
+        def getShuntVoltage_mV(self):
+            self.reads += 1
+            return wave(self.reads, 2, 1)
+
+        def getBusVoltage_V(self):
+            return wave(self.reads, 12.5, 0.5)
+
+        def getCurrent_mA(self):
+            return wave(self.reads, 200, 100)
+
+    fake_module('lib.Subfact_ina219', INA219=INA219)
+    module = load('ina219_power.py')
+    sampler = module.sampler
+
+    # what the sampler thread does between cycles, done up front
+    def collect(out, ts):
+        for _ in xrange(module.SAMPLES):
+            reading = module.read_modules()
+            with sampler.lock:
+                for field, value in reading.iteritems():
+                    sampler.buffers[field].append(value)
+        real_collect(out, ts)
+
+    real_collect = module.collect
+    module.collect = collect
+    return module
+
+
+REPLAYS = [
+    ('arris-modem', replay_arris),
+    ('smartctl_stat', replay_smartctl),
+    ('smartlinc_imeter', replay_smartlinc),
+    ('chef-server', replay_chef),
+    ('dht_temp', replay_dht),
+    ('get-bme280', replay_bme280),
+    ('ina219_power', replay_ina219),
+]
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1,
+                       int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def measure(replay, cycles):
+    """Sets up one collector and times cycles of it. Returns a dict of
+    results.
+    """
+
+    module = replay()
+    devnull = open(os.devnull, 'w')
+    # rates are worked out as usual, but not kept in the collector's state
+    # file
+    out = emitter.Emitter(stream=devnull,
+                          rates=getattr(module, 'RATES', None))
+    interval = module.INTERVAL
+    ts = 1500000000
+
+    # one untimed cycle to fill caches and start connections
+    module.collect(out, ts)
+    out.flush()
+
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    else:
+        objects = len(gc.get_objects())
+
+    points = 0
+    times = []
+    for cycle in xrange(1, cycles + 1):
+        starttime = time.time()
+        module.collect(out, ts + cycle * interval)
+        points += len(out.buffer)
+        out.flush()
+        times.append(time.time() - starttime)
+
+    if tracemalloc is not None:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        alloc = peak / 1024.0
+    else:
+        gc.collect()
+        alloc = float(len(gc.get_objects()) - objects) / cycles
+
+    times.sort()
+    return {
+        'points': points / cycles,
+        'p50': percentile(times, 0.50),
+        'p95': percentile(times, 0.95),
+        'p99': percentile(times, 0.99),
+        'rate': points / sum(times),
+        'alloc': alloc,
+    }
+
+
+def run(replay, cycles, verbose):
+    """Runs measure() in a child, returns (results, peak RSS in KB), or
+    None if the child failed.
+    """
+
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        if not verbose:
+            null = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(null, 2)
+        try:
+            os.write(wfd, json.dumps(measure(replay, cycles)))
+        except Exception, e:
+            print >> sys.__stdout__, "%s failed: %s" % (replay.__name__, e)
+        os._exit(0)
+
+    os.close(wfd)
+    result = ''
+    while True:
+        chunk = os.read(rfd, 4096)
+        if not chunk:
+            break
+        result += chunk
+    os.close(rfd)
+    _, _, usage = os.wait4(pid, 0)
+    if not result:
+        return None
+    return json.loads(result), usage.ru_maxrss
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [-n CYCLES] [-v] "
+                                   "[COLLECTOR ...]")
+    parser.add_option("-n", "--cycles", type="int", default=200,
+                      help="cycles to time per collector (default: %default)")
+    parser.add_option("-v", "--verbose", action="store_true",
+                      help="show what the collectors print to stderr")
+    options, args = parser.parse_args()
+
+    replays = [(name, replay) for name, replay in REPLAYS
+               if not args or name in args]
+    if not replays:
+        parser.error("no collectors named %s" % " ".join(args))
+
+    if tracemalloc is not None:
+        alloc = "peak KB"
+    else:
+        alloc = "objs/cycle"
+    print "%d cycles per collector" % options.cycles
+    print "%-17s %7s %8s %8s %8s %11s %10s %8s" % (
+        "collector", "pts/cyc", "p50 ms", "p95 ms", "p99 ms", "points/sec",
+        alloc, "RSS KB")
+    for name, replay in replays:
+        result = run(replay, options.cycles, options.verbose)
+        if result is None:
+            print "%-17s %7s" % (name, "failed")
+            continue
+        stats, rss = result
+        print "%-17s %7d %8.3f %8.3f %8.3f %11d %10.1f %8d" % (
+            name, stats['points'], stats['p50'] * 1000, stats['p95'] * 1000,
+            stats['p99'] * 1000, stats['rate'], stats['alloc'], rss)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,21 +6,39 @@
 
 """A collector to gather channel statistics from an Arris cable modem
 
-This parses the HTML tables from the Arris WebUI's status pages. By default
+This parses the HTML tables from the Arris WebUI's status pages as they
+stream in, keeping only the rows of the tables it needs. By default
 this is at 192.168.100.1 and the page is unauthenticated. This should just
 work on your network even if your LAN isn't numbered 192.168.100.x, as
 192.168.100.1 is "upstream" of your router.
 
-This collects from the modem every 30 seconds ('interval = 30' in main()).
-It takes about 6 seconds to return the page so there's not much sense to
-poll faster.
+The SB6183 and SB8200 are known (MODEL below). Their channel tables are
+described column by column in MODELS; each table's header row is matched
+against that once per distinct layout, so a firmware that reorders or
+adds columns is still read right.
 
-Note: This depends on BeautifulSoup 3 (maybe works with 4?). On CentOS you'll
-want to install the python-BeautifulSoup package.
+This collects from the modem every 30 seconds (INTERVAL) at most,
+on the aligned ticks collectors/lib/scheduler.py hands out.
+It takes about 6 seconds to return each page so there's not much sense to
+poll faster. Both pages are fetched at the same time, and whatever has come
+back within CYCLE_DEADLINE seconds is reported; a late page is skipped
+until its request finishes, and then reported on a later cycle with the
+timestamp of the cycle that asked for it.
+
+When the modem slows down, polls are spaced out to keep it answering us no
+more than POLL_BUDGET of the time, and when a poll fails or times out the
+period doubles, up to POLL_MAX, until one succeeds again (see
+AdaptiveInterval in collectors/lib/scheduler.py).
 
 Global metrics:
-arris.req.time_s    How many seconds it took to fetch the status page
+arris.req.time_s    How many seconds it took to fetch and parse a page,
+                    tagged with page=status or page=swinfo
+arris.poll_interval_s  Seconds until the next poll of the modem
 arris.uptime        Uptime of modem in seconds
+arris.http.*        Connection reuse and request latency, tagged with
+                    host=, see collectors/lib/httpclient.py
+tcollector.self.*   Time spent fetching pages and emitting their tables,
+                    points and errors, see collectors/lib/selfstats.py
 
 Per channel metrics, with channel=X as a tag:
 Downstream channels
@@ -33,219 +51,391 @@ arris.down.snr_db              Channel signal to noise ratio, in DB
 arris.down.corrected_errors    Frame errors that were correctable
 arris.down.uncorrected_errors  Frame errors that were not correctable
 arris.down.total_errors        Sum of correctable and non-correctable errors
+arris.down.*_errors_per_s      Per-second rate of each of the error counters
+arris.down.channels_locked     Number of locked channels, untagged
 
 Upstream channels
 arris.up.lock_status           Is channel locked/operational(1) or not (0)
-arris.up.channel_type          Channel type (ATDMA->1)
+arris.up.channel_type          Channel type
+                               (ATDMA->1, SC-QAM->2, OFDMA->3)
 arris.up.channel_id            Channel id
                                (can be different than UI channel number)
 arris.up.symbol_rate_ksec      Symbol rate, in kilosymbols/second
 arris.up.frequency_hz          Channel frequency in hertz
+arris.up.width_hz              Channel width in hertz (SB8200)
 arris.up.power_dbmvolt         Channel power, in dBmV
+arris.up.channels_locked       Number of locked channels, untagged
 
 """
 
-import os
+import HTMLParser
 import re
-import pwd
 import sys
+import threading
 import time
-import urllib2
-from BeautifulSoup import BeautifulSoup
+from collectors.lib import emitter
+from collectors.lib import htmltables
+from collectors.lib import httpclient
+from collectors.lib import privileges
+from collectors.lib import scheduler
+from collectors.lib import selfstats
 
 # If we're running as root and this user exists, we'll drop privileges. Set
 # this to 'root' if you don't want to drop privileges.
 USER = "nobody"
+INTERVAL = 30
+
+# Send a value only when it changed, or every DEDUP_HEARTBEAT cycles
+# regardless. 0 sends every value every cycle.
+DEDUP_HEARTBEAT = 0
+
+# Error counters also sent as per-second rates. The last count of each
+# channel is kept in RATE_STATE across restarts, and counts going down (the
+# modem rebooted) reset the rate rather than sending a negative one.
+RATES = {
+    'arris.down.corrected_errors': 'arris.down.corrected_errors_per_s',
+    'arris.down.uncorrected_errors': 'arris.down.uncorrected_errors_per_s',
+    'arris.down.total_errors': 'arris.down.total_errors_per_s',
+}
+RATE_STATE = "/var/tmp/tcollector-arris-modem.rates"
+
+# The modem's address, and which model it is, one of MODELS below
+MODEM = "192.168.100.1"
+MODEL = "SB6183"
+# Both pages are fetched at once, each must be back within CYCLE_DEADLINE
+# seconds or the cycle goes on without it.
+CYCLE_DEADLINE = 25
+# Longest the modem is left alone while it's failing, and the share of
+# time it may spend answering us
+POLL_MAX = 600
+POLL_BUDGET = 0.25
+
+MODULATIONS = {
+    'QAM256': 256,
+    'QAM64': 64,
+    'QAM16': 16,
+    'QPSK': 4,
+}
+CHANNEL_TYPES = {
+    'ATDMA': 1,
+    'SC-QAM': 2,
+    'OFDMA': 3,
+}
+
+UPTIME = re.compile(r'(\d+)\s+days\s+(\d+)h:(\d+)m:(\d+)s', re.IGNORECASE)
+
+
+def lock_status(text):
+    return 1 if text == 'Locked' else 0
+
+
+def modulation(text):
+    return MODULATIONS.get(text, -1)
+
+
+def channel_type(text):
+    return CHANNEL_TYPES.get(text, -1)
+
+
+def number(text):
+    """Returns the number a cell starts with, such as 573000000 for
+    "573000000 Hz" or 6.2 for "6.2 dBmV". Raises ValueError for cells like
+    "----" on channels that aren't locked.
+    """
+
+    text = text.partition(' ')[0]
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+class TableSchema(object):
+    """How the rows of one kind of channel table map to metrics.
+
+    keys are the header texts the channel number's column may go by, the
+    first one in the header row wins. columns are (header text, metric,
+    converter) in the order they're sent. totals are (metric, (metric,
+    ...)) sums of other metrics of the same row, and locked is the metric
+    counting the channels that are locked.
+
+    The header row is found by its channel column, and compiled into the
+    column indexes to read. That's done once per distinct header row, so
+    a firmware that moves or drops columns just gets its own plan.
+    """
+
+    def __init__(self, keys, columns, totals=(), locked=None):
+        self.keys = keys
+        self.columns = columns
+        self.totals = totals
+        self.locked = locked
+        self.lock_status = None
+        for _, metric, convert in columns:
+            if convert is lock_status:
+                self.lock_status = metric
+        # header row -> (key index, ((index, metric, converter), ...))
+        self.plans = {}
+
+    def compile(self, header):
+        """Returns the plan for a header row, or None if it isn't one."""
+
+        header = tuple(header)
+        try:
+            return self.plans[header]
+        except KeyError:
+            pass
+
+        for key in self.keys:
+            if key in header:
+                break
+        else:
+            return None
+        plan = (header.index(key),
+                tuple((header.index(text), metric, convert)
+                      for text, metric, convert in self.columns
+                      if text in header))
+        self.plans[header] = plan
+        return plan
+
+    def parse(self, rows):
+        """Yields (metric, value, tags) for every channel row, then the
+        locked channel count.
+        """
+
+        plan = None
+        locked = 0
+        for cols in rows:
+            if plan is None:
+                plan = self.compile(cols)
+                continue
+            key, columns = plan
+            if len(cols) <= key or not cols[key].isdigit():
+                continue
 
-def drop_privileges():
-    """Drops privileges if running as root."""
-
-    if USER == 'root':
-        return
-
+            tags = {'channel': cols[key]}
+            values = {}
+            for index, metric, convert in columns:
+                if index >= len(cols):
+                    continue
+                try:
+                    value = values[metric] = convert(cols[index])
+                except ValueError:
+                    continue
+                yield metric, value, tags
+            for metric, parts in self.totals:
+                if all(part in values for part in parts):
+                    yield metric, sum(values[part] for part in parts), tags
+            if values.get(self.lock_status) == 1:
+                locked += 1
+
+        if self.locked:
+            yield self.locked, locked, None
+
+
+DOWNSTREAM = (
+    ('Lock Status', 'down.lock_status', lock_status),
+    ('Modulation', 'down.modulation', modulation),
+    ('Frequency', 'down.frequency_hz', number),
+    ('Power', 'down.power_dbmvolt', number),
+    ('SNR', 'down.snr_db', number),
+    ('SNR/MER', 'down.snr_db', number),
+    ('Corrected', 'down.corrected_errors', int),
+    ('Uncorrectables', 'down.uncorrected_errors', int),
+)
+DOWNSTREAM_TOTALS = (
+    ('down.total_errors', ('down.corrected_errors',
+                           'down.uncorrected_errors')),
+)
+UPSTREAM = (
+    ('Lock Status', 'up.lock_status', lock_status),
+    ('US Channel Type', 'up.channel_type', channel_type),
+    ('Channel ID', 'up.channel_id', int),
+    ('Symbol Rate', 'up.symbol_rate_ksec', number),
+    ('Frequency', 'up.frequency_hz', number),
+    ('Width', 'up.width_hz', number),
+    ('Power', 'up.power_dbmvolt', number),
+)
+
+# Per model: the pages to fetch, with which of their tables to parse
+# (picked by a keyword in their <th> title), and the schema of each channel
+# table. The 'swinfo' table holds the uptime.
+MODELS = {
+    'SB6183': {
+        'pages': {
+            'status': ('RgConnect.asp', {'downstream': 'Downstream',
+                                         'upstream': 'Upstream'}),
+            'swinfo': ('RgSwInfo.asp', {'swinfo': 'Status'}),
+        },
+        'tables': {
+            'downstream': TableSchema(('Channel',), DOWNSTREAM,
+                                      DOWNSTREAM_TOTALS,
+                                      'down.channels_locked'),
+            'upstream': TableSchema(('Channel',), UPSTREAM,
+                                    locked='up.channels_locked'),
+        },
+    },
+    # DOCSIS 3.1; downstream rows have no UI channel number, so they're
+    # tagged with the channel id
+    'SB8200': {
+        'pages': {
+            'status': ('cmconnectionstatus.html', {'downstream': 'Downstream',
+                                                   'upstream': 'Upstream'}),
+            'swinfo': ('cmswinfo.html', {'swinfo': 'Status'}),
+        },
+        'tables': {
+            'downstream': TableSchema(('Channel', 'Channel ID'), DOWNSTREAM,
+                                      DOWNSTREAM_TOTALS,
+                                      'down.channels_locked'),
+            'upstream': TableSchema(('Channel',), UPSTREAM,
+                                    locked='up.channels_locked'),
+        },
+    },
+}
+PAGES = MODELS[MODEL]['pages']
+TABLES = MODELS[MODEL]['tables']
+
+# A kept-alive connection per page
+http = httpclient.HTTPClient(pool_size=len(PAGES), idle_timeout=60,
+                             timeout=CYCLE_DEADLINE)
+poll = scheduler.AdaptiveInterval(INTERVAL, POLL_MAX, POLL_BUDGET)
+# key -> (thread, result, ts it was started on) of page fetches not yet
+# reported
+fetches = {}
+
+self_stats = selfstats.SelfStats('arris-modem')
+
+
+def fetch_page(pagename, wanted, result):
+    """Fetches one page and pulls out the wanted tables. Runs in its own
+    thread, so everything is handed back in the result dict: 'time' taken,
+    and either an 'error' message or the http 'status' and parsed 'tables'.
+    """
+
+    tables = htmltables.TableExtractor(wanted)
+    starttime = time.time()
     try:
-        ent = pwd.getpwnam(USER)
-    except KeyError:
-        return
+        status, _ = http.get(MODEM, "/%s" % pagename, stream=tables.feed)
+        tables.close()
+        result['status'] = status
+        result['tables'] = tables.rows
+    except httpclient.HTTPClientError, e:
+        result['error'] = "http error for %s: %s" % (pagename, e)
+    except HTMLParser.HTMLParseError, e:
+        result['error'] = "parse error for %s: %s" % (pagename, e)
+    finally:
+        result['time'] = time.time() - starttime
+
+
+def parse_swinfo(out, ts, rows):
+    for cols in rows:
+        # Only parse uptime row
+        if len(cols) < 2 or cols[0] != 'Up Time':
+            continue
 
-    if os.getuid() != 0:
-        return
-    os.setgid(ent.pw_gid)
-    os.setuid(ent.pw_uid)
+        # Will this thing ever print years?
+        m = UPTIME.match(cols[1])
+        if m is None:
+            continue
+        days, hours, minutes, seconds = map(int, m.groups())
+        out.emit('arris.uptime', ts,
+                 days * 86400 + hours * 3600 + minutes * 60 + seconds)
 
 
-def main():
-    """Main loop"""
+def parse_table(out, ts, rows, table):
+    for metric, value, tags in TABLES[table].parse(rows):
+        out.emit('arris.' + metric, ts, value, tags)
 
-    drop_privileges()
-    sys.stdin.close()
 
-    interval = 30
+def collect(out, ts):
+    """Fetches the status pages and reports whatever came back in time,
+    if the modem is due a poll
+    """
 
-    def print_stat(metric, value, tags=""):
-        if value is not None:
-            print "arris.%s %d %s %s" % (metric, ts, value, tags)
+    if not poll.due(ts):
+        return
 
-    def parse_swinfo(rows):
-        for row in rows:
-            cols = row.findAll('td')
-            if not cols:
-                continue
-            cols = [ele.text.strip() for ele in cols]
-            # Only parse uptime row
-            if not cols[0] == 'Up Time':
+    starttime = time.time()
+    deadline = starttime + CYCLE_DEADLINE
+
+    with self_stats.phase('fetch'):
+        for key, (pagename, wanted) in PAGES.iteritems():
+            if key in fetches and fetches[key][0].is_alive():
+                # still stuck on last cycle's request, don't pile on
                 continue
+            result = {}
+            fetch = threading.Thread(target=fetch_page,
+                                     args=(pagename, wanted, result))
+            fetch.daemon = True
+            fetch.start()
+            fetches[key] = (fetch, result, ts)
+
+        for fetch, _, _ in fetches.values():
+            fetch.join(max(0, deadline - time.time()))
+
+    failed = False
+    latency = 0
+    for key, (fetch, result, fetch_ts) in fetches.items():
+        pagename = PAGES[key][0]
+        if fetch.is_alive():
+            print >> sys.stderr, ("%s not back after %ds, skipping it"
+                                  % (pagename, CYCLE_DEADLINE))
+            self_stats.error()
+            failed = True
+            continue
+        del fetches[key]
+
+        # a page that ran late was asked for by an earlier cycle, and its
+        # values are from then
+        out.emit('arris.req.time_s', fetch_ts, result['time'],
+                 {'page': key})
+        latency = max(latency, result['time'])
+
+        if 'status' not in result:
+            print >> sys.stderr, result.get('error',
+                                            "%s fetch failed" % pagename)
+            self_stats.error()
+            failed = True
+            continue
+
+        if result['status'] != 200:
+            print >> sys.stderr, ("modem returned http code %s for %s" %
+                                  (result['status'], pagename))
+            self_stats.error()
+            failed = True
+            continue
+
+        with self_stats.phase('emit'):
+            for table, rows in result['tables'].iteritems():
+                if table == 'swinfo':
+                    parse_swinfo(out, fetch_ts, rows)
+                else:
+                    parse_table(out, fetch_ts, rows, table)
+
+    if failed:
+        poll.failure()
+    else:
+        poll.success(latency)
+    out.emit('arris.poll_interval_s', ts, poll.interval)
+
+    for host, name, value in http.metrics():
+        out.emit('arris.http.' + name, ts, value, {'host': host})
 
-            parse_uptime(cols[1])
 
-    def parse_uptime(uptime):
-        # Will this thing ever print years?
-        m = re.match(r'(\d+)\s+days\s+(\d+)h:(\d+)m:(\d+)s',
-                     uptime,
-                     re.IGNORECASE)
-        uptime_seconds = (
-            (int(m.group(1)) * 86400) +
-            (int(m.group(2)) * 3600) +
-            (int(m.group(3)) * 60) +
-            int(m.group(4))
-        )
-
-        print_stat('uptime', uptime_seconds)
-
-    def parse_table(rows, table):
-
-        # Map text to a value
-        def modulation_dict(text):
-            return {
-                'QAM256': 256,
-                'QAM64': 64,
-                'QAM16': 16,
-                'QPSK': 4,
-            }.get(text, -1)
-
-        # Map text to a value
-        def channeltype_dict(text):
-            return {
-                'ATDMA': 1,
-            }.get(text, -1)
-
-        # Channels in locked state
-        locked_down = 0
-        locked_up = 0
-
-        for row in rows:
-            cols = row.findAll('td')
-            if not cols:
-                continue
-            cols = [ele.text.strip() for ele in cols]
-            # Only parse rows with a channel number
-            if not cols[0].isdigit():
-                continue
+def main():
+    """Main loop"""
 
-            channel = cols[0]
-            tags = 'channel=' + channel
-
-            if table == 'downstream':
-                lock_status = cols[1]
-                modulation = modulation_dict(cols[2])
-                channel_id = cols[3]
-                frequency = cols[4].split()[0]
-                power = cols[5].split()[0]
-                snr = cols[6].split()[0]
-                corrected = cols[7]
-                uncorrected = cols[8]
-                total_errors = corrected + uncorrected
-
-                lock_status = '1' if lock_status == 'Locked' else '0'
-                if lock_status == '1':
-                    locked_down += 1
-
-                print_stat('down.lock_status', lock_status, tags)
-                print_stat('down.modulation', modulation, tags)
-                print_stat('down.frequency_hz', frequency, tags)
-                print_stat('down.power_dbmvolt', power, tags)
-                print_stat('down.snr_db', snr, tags)
-                print_stat('down.corrected_errors', corrected, tags)
-                print_stat('down.uncorrected_errors', uncorrected, tags)
-                print_stat('down.total_errors', total_errors, tags)
-
-            if table == 'upstream':
-                lock_status = cols[1]
-                channel_type = channeltype_dict(cols[2])
-                channel_id = cols[3]
-                symbol_rate = cols[4].split()[0]
-                frequency = cols[5].split()[0]
-                power = cols[6].split()[0]
-
-                lock_status = '1' if lock_status == 'Locked' else '0'
-                if lock_status == '1':
-                    locked_up += 1
-
-                print_stat('up.lock_status', lock_status, tags)
-                print_stat('up.channel_type', channel_type, tags)
-                print_stat('up.channel_id', channel_id, tags)
-                print_stat('up.symbol_rate_ksec', symbol_rate, tags)
-                print_stat('up.frequency_hz', frequency, tags)
-                print_stat('up.power_dbmvolt', power, tags)
-
-        if table == 'downstream':
-            print_stat('down.channels_locked', locked_down)
-        if table == 'upstream':
-            print_stat('up.channels_locked', locked_up)
-
-    while True:
-        ts = int(time.time())
-        tags = ''
-
-        pages = {
-            'status': 'RgConnect.asp',
-            'swinfo': 'RgSwInfo.asp',
-        }
-
-        for key, pagename in pages.iteritems():
-            starttime = time.time()
-            try:
-                req = urllib2.urlopen("http://192.168.100.1/%s" % pagename,
-                                      timeout=30)
-            except urllib2.HTTPError, e:
-                print >> sys.stderr, ("urlopen http error for %s: %s" %
-                                      (pagename, e.code))
-                continue
-            except urllib2.URLError, e:
-                print >> sys.stderr, ("urlopen url error for %s: %s" %
-                                      (pagename, e.args))
-                continue
+    privileges.drop_privileges(USER)
+    sys.stdin.close()
 
-            endtime = time.time()
-            reqtime = endtime - starttime
-
-            if key == 'status':
-                print_stat('req.time_s', reqtime)
-
-            if req is not None:
-                soup = BeautifulSoup(req.read())
-                req.close()
-                alltables = soup.findAll('table')
-
-                for table in alltables:
-                    headers = table.findAll('th')
-                    for header in headers:
-                        if key == 'status' and 'Downstream' in str(header):
-                            parse_table(table.findAll('tr'),
-                                        table='downstream')
-                        if key == 'status' and 'Upstream' in str(header):
-                            parse_table(table.findAll('tr'),
-                                        table='upstream')
-                        if key == 'swinfo' and 'Status' in str(header):
-                            parse_swinfo(table.findAll('tr'))
-
-            else:
-                print >> sys.stderr, ("modem returned http code: %s" %
-                                      req.getcode())
-
-        req.close()
-        sys.stdout.flush()
-        time.sleep(interval)
+    out = emitter.Emitter(heartbeat=DEDUP_HEARTBEAT, rates=RATES,
+                          rate_state=RATE_STATE)
+    sched = scheduler.Scheduler(INTERVAL)
+    for ts in sched:
+        with self_stats.cycle():
+            collect(out, ts)
+        self_stats.report(out, ts, sched.missed)
+        with self_stats.phase('flush'):
+            out.flush()
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -22,43 +22,403 @@
 #
 # Private Chef Server ("OPC") metrics:
 #
+# By default the stats script runs inside one long-lived `knife exec` of
+# etc/chef-server-stats-worker.rb, so Ruby and knife only start up once. We
+# ask it for stats by writing a line to its stdin and read one line of JSON
+# back. If it dies or stops answering, it's killed and started again on the
+# next cycle, backing off if it keeps failing. Set WORKER_MODE = False to
+# run `knife exec` on the stats script every cycle instead.
+#
+# The object counts from the stats script change slowly and cost a Chef API
+# round trip, so it only runs every CHEF_INTERVAL seconds, in a thread of
+# its own so the faster backends below keep their ticks, and its last
+# result is sent every STATS_INTERVAL. The postgresql_* and rabbitmq_*
+# metrics are read directly instead, on their own faster intervals:
+# postgresql_* from pg_stat_user_tables (summed over all tables) and
+# pg_stat_activity over one kept-open connection, which needs psycopg2, and
+# rabbitmq_messages_ready from the RabbitMQ management API. While a direct
+# backend is working, the same metrics from the stats script are ignored.
+#
+# Time spent in each direct backend goes out as tcollector.self.phase_time_s,
+# and the seconds the last stats script run took as
+# tcollector.self.knife_time_s, with the other tcollector.self.* metrics
+# described in collectors/lib/selfstats.py.
+#
 
+import base64
 import json
 import os
 import pwd
+import select
+import signal
 import subprocess
 import sys
+import threading
 import time
+import urllib
+from collectors.lib import emitter
+from collectors.lib import httpclient
+from collectors.lib import scheduler
+from collectors.lib import selfstats
 
+try:
+  import psycopg2
+except ImportError:
+  psycopg2 = None
 
-def main():
-  """collector main loop"""
+# Send a value only when it changed, or every DEDUP_HEARTBEAT cycles
+# regardless. 0 sends every value every cycle.
+DEDUP_HEARTBEAT = 0
+
+# knife needs root's Chef credentials
+USER = "root"
+
+STATS_SCRIPT = "/root/chef-server-stats.rb"
+WORKER_MODE = True
+# Seconds to wait for the worker to answer a stats request, or for a fresh
+# knife exec of the stats script to finish
+WORKER_TIMEOUT = 25
+# Seconds to wait before restarting a worker that died, doubling up to
+# WORKER_BACKOFF_MAX while it keeps dying
+WORKER_BACKOFF_MIN = 30
+WORKER_BACKOFF_MAX = 600
+
+# Seconds between runs of the stats script, and between sending its last
+# result
+CHEF_INTERVAL = 300
+STATS_INTERVAL = 30
+
+# Direct PostgreSQL stats, None to leave them to the stats script
+POSTGRES_DSN = "dbname=opscode_chef user=opscode-pgsql host=/tmp"
+POSTGRES_INTERVAL = 10
+
+# Direct RabbitMQ stats from the management API, None to leave them to the
+# stats script
+RABBITMQ_HOST = "localhost:15672"
+RABBITMQ_VHOST = "/chef"
+RABBITMQ_USER = "guest"
+RABBITMQ_PASSWORD = "guest"
+RABBITMQ_INTERVAL = 10
+
+# Columns of pg_stat_user_tables summed into chef.server.postgresql_<column>
+PG_TABLE_COLUMNS = ('seq_scan', 'seq_tup_read', 'idx_scan', 'idx_tup_fetch',
+                    'n_tup_ins', 'n_tup_upd', 'n_tup_del', 'n_live_tup',
+                    'n_dead_tup')
+
+INTERVAL = min(STATS_INTERVAL, POSTGRES_INTERVAL, RABBITMQ_INTERVAL)
+
+# The stats worker, and a Backend for each direct stats source, set up by
+# setup()
+worker = None
+backends = []
+# Last result of the stats script, when it was last started and sent, and
+# the thread running it
+chef_stats = {}
+chef_last_run = 0
+stats_last_sent = 0
+chef_refresh = None
+
+self_stats = selfstats.SelfStats('chef-server')
+
+
+class StatsWorker(object):
+  """A knife exec process answering stats requests one JSON line at a time"""
+
+  def __init__(self, argv):
+    self.argv = argv
+    self.proc = None
+    self.buffer = ''
+    self.decoder = json.JSONDecoder()
+    self.backoff = WORKER_BACKOFF_MIN
+    self.next_start = 0
+
+  def start(self):
+    env = dict(os.environ, CHEF_STATS_SCRIPT=STATS_SCRIPT)
+    self.proc = subprocess.Popen(self.argv, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE, env=env,
+                                 close_fds=True)
+    self.buffer = ''
+
+  def stop(self):
+    if self.proc is None:
+      return
+    if self.proc.poll() is None:
+      self.proc.kill()
+    self.proc.wait()
+    self.proc = None
+    self.next_start = time.time() + self.backoff
+    self.backoff = min(self.backoff * 2, WORKER_BACKOFF_MAX)
+
+  def request(self, timeout):
+    """Asks the worker for stats, returns the decoded dict or None."""
+
+    if self.proc is not None and self.proc.poll() is not None:
+      print >> sys.stderr, ("stats worker exited with %d"
+                            % self.proc.returncode)
+      self.stop()
+    if self.proc is None:
+      if time.time() < self.next_start:
+        return None
+      self.start()
+
+    try:
+      self.proc.stdin.write('\n')
+      self.proc.stdin.flush()
+    except IOError, e:
+      print >> sys.stderr, "can't write to stats worker: %s" % e
+      self.stop()
+      return None
+
+    deadline = time.time() + timeout
+    fd = self.proc.stdout.fileno()
+    while '\n' not in self.buffer:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        print >> sys.stderr, "stats worker didn't answer, restarting it"
+        self.stop()
+        return None
+      readable, _, _ = select.select([fd], [], [], remaining)
+      if not readable:
+        continue
+      chunk = os.read(fd, 65536)
+      if not chunk:
+        print >> sys.stderr, "stats worker closed its output"
+        self.stop()
+        return None
+      self.buffer += chunk
+
+    line, self.buffer = self.buffer.split('\n', 1)
+    try:
+      stats, _ = self.decoder.raw_decode(line.strip())
+    except ValueError, e:
+      print >> sys.stderr, "bad JSON from stats worker: %s" % e
+      return None
+
+    self.backoff = WORKER_BACKOFF_MIN
+    if 'error' in stats:
+      print >> sys.stderr, "stats worker error: %s" % stats['error']
+      return None
+    return stats
+
+
+class Backend(object):
+  """A direct stats source, how often it runs and its last result"""
+
+  def __init__(self, source, interval):
+    self.source = source
+    self.interval = interval
+    self.last_run = 0
+    # None before the first run and while the source is failing
+    self.stats = None
+
+
+class PostgresStats(object):
+  """Table and connection stats over one kept-open connection"""
+
+  name = 'postgresql'
+  prefix = 'chef.server.postgresql_'
+
+  def __init__(self, dsn):
+    self.dsn = dsn
+    self.conn = None
+    self.query = ("SELECT %s FROM pg_stat_user_tables"
+                  % ", ".join("COALESCE(SUM(%s), 0)" % column
+                              for column in PG_TABLE_COLUMNS))
+
+  def collect(self):
+    """Returns a dict of metric to value, or None if the query failed."""
+
+    try:
+      if self.conn is None:
+        self.conn = psycopg2.connect(self.dsn)
+        # stats views are frozen for the length of a transaction
+        self.conn.autocommit = True
+      cursor = self.conn.cursor()
+      cursor.execute(self.query)
+      row = cursor.fetchone()
+      cursor.execute("SELECT COUNT(*) FROM pg_stat_activity")
+      connections = cursor.fetchone()[0]
+      cursor.close()
+    except psycopg2.Error, e:
+      print >> sys.stderr, "postgresql stats failed: %s" % e
+      if self.conn is not None:
+        self.conn.close()
+        self.conn = None
+      return None
+
+    stats = dict((self.prefix + column, int(value))
+                 for column, value in zip(PG_TABLE_COLUMNS, row))
+    stats[self.prefix + 'connection_count'] = int(connections)
+    return stats
+
+
+class RabbitMQStats(object):
+  """Queue depth from the RabbitMQ management API"""
+
+  name = 'rabbitmq'
+  prefix = 'chef.server.rabbitmq_'
+
+  def __init__(self, host, vhost, user, password):
+    self.host = host
+    self.path = "/api/queues/%s" % urllib.quote(vhost, safe='')
+    self.headers = {
+      'Authorization': 'Basic ' + base64.b64encode(user + ':' + password),
+    }
+    self.http = httpclient.HTTPClient(pool_size=1, idle_timeout=60,
+                                      timeout=5)
+
+  def collect(self):
+    """Returns a dict of metric to value, or None if the request failed."""
+
+    try:
+      status, body = self.http.get(self.host, self.path,
+                                   headers=self.headers)
+    except httpclient.HTTPClientError, e:
+      print >> sys.stderr, "rabbitmq stats failed: %s" % e
+      return None
+    if status != 200:
+      print >> sys.stderr, "rabbitmq management api returned %d" % status
+      return None
+
+    try:
+      queues = json.loads(body)
+    except ValueError, e:
+      print >> sys.stderr, "bad JSON from rabbitmq: %s" % e
+      return None
+    ready = sum(queue.get('messages_ready', 0) for queue in queues)
+    return {self.prefix + 'messages_ready': ready}
+
+
+def run_stats_script(timeout):
+  """Runs the stats script in a fresh knife exec, returns the decoded dict
+  or None. knife is killed if it runs longer than timeout seconds.
+  """
+
+  # in a process group of its own, so anything knife started goes too and
+  # lets go of stdout
+  stats = subprocess.Popen(
+    [ 'knife', 'exec', STATS_SCRIPT ],
+    stdin=None, stdout=subprocess.PIPE, bufsize=1, preexec_fn=os.setsid)
+
+  def kill():
+    print >> sys.stderr, "knife exec ran over %ds, killing it" % timeout
+    try:
+      os.killpg(stats.pid, signal.SIGKILL)
+    except OSError:
+      pass  # just exited
+
+  timer = threading.Timer(timeout, kill)
+  timer.start()
+  try:
+    ( stdout, err ) = stats.communicate()
+  finally:
+    timer.cancel()
+
+  if stats.returncode != 0:
+    return None
+  try:
+    return json.loads(stdout, encoding='utf-8')
+  except ValueError, e:
+    print >> sys.stderr, "bad JSON from stats script: %s" % e
+    return None
+
+
+def refresh_chef_stats():
+  """Runs the stats script and keeps its chef.server.* metrics in
+  chef_stats. Runs on its own thread, started by collect().
+  """
+
+  global chef_stats
+
+  # phases are only timed on the cycle's thread, set() is safe from this one
+  start = time.time()
+  if worker is not None:
+    stats_json = worker.request(WORKER_TIMEOUT)
+  else:
+    stats_json = run_stats_script(WORKER_TIMEOUT)
+  self_stats.set('knife_time_s', round(time.time() - start, 3))
+  if not stats_json:
+    self_stats.error()
+    return
+  chef_stats = dict((str(metric), value)
+                    for metric, value in stats_json.iteritems()
+                    if metric.startswith('chef.server'))
+
+
+def setup():
+  """Checks for knife and the stats script, sets up the stats sources"""
+
+  global worker
 
   # Don't run if we don't have Chef knife or the stat script
   if not os.path.exists("/usr/bin/knife"):
     sys.exit(13)
-  if not os.path.exists("/root/chef-server-stats.rb"):
+  if not os.path.exists(STATS_SCRIPT):
     sys.exit(13)
 
-  interval = 30
+  if WORKER_MODE:
+    worker_script = (os.path.dirname(os.path.abspath(__file__)) +
+                     "/../etc/chef-server-stats-worker.rb")
+    worker = StatsWorker([ 'knife', 'exec', worker_script ])
+
+  if POSTGRES_DSN and psycopg2 is None:
+    print >> sys.stderr, "no psycopg2, leaving postgresql to the stats script"
+  elif POSTGRES_DSN:
+    backends.append(Backend(PostgresStats(POSTGRES_DSN), POSTGRES_INTERVAL))
+  if RABBITMQ_HOST:
+    backends.append(Backend(RabbitMQStats(RABBITMQ_HOST, RABBITMQ_VHOST,
+                                          RABBITMQ_USER, RABBITMQ_PASSWORD),
+                            RABBITMQ_INTERVAL))
 
-  while True:
-    ts = int(time.time())
 
-    stats = subprocess.Popen(
-      [ 'knife', 'exec', '/root/chef-server-stats.rb' ],
-      stdin=None, stdout=subprocess.PIPE, bufsize=1)
-    ( out, err ) = stats.communicate()
+def collect(out, ts):
+  """Runs whichever stats sources are due"""
 
-    if stats.returncode == 0:
-      stats_json = json.loads(out, encoding='utf-8')
-      #print json.dumps(stats_json, sort_keys=True, indent=4, separators=(',', ': '))
-      for metric in stats_json:
-        if metric.startswith('chef.server'):
-          print ("%s %d %s" % (metric, ts, stats_json[metric]))
+  global chef_last_run, stats_last_sent, chef_refresh
+
+  for backend in backends:
+    if ts - backend.last_run < backend.interval:
+      continue
+    backend.last_run = ts
+    with self_stats.phase(backend.source.name):
+      backend.stats = backend.source.collect()
+    if backend.stats is None:
+      self_stats.error()
+    else:
+      for metric, value in backend.stats.iteritems():
+        out.emit(metric, ts, value)
+
+  # a refresh still running from earlier keeps going, rather than starting
+  # a second knife next to it
+  if (ts - chef_last_run >= CHEF_INTERVAL and
+      (chef_refresh is None or not chef_refresh.is_alive())):
+    chef_last_run = ts
+    chef_refresh = threading.Thread(target=refresh_chef_stats)
+    chef_refresh.daemon = True
+    chef_refresh.start()
+
+  if ts - stats_last_sent >= STATS_INTERVAL:
+    stats_last_sent = ts
+    # leave out whatever a working direct backend already sent
+    skip = tuple(backend.source.prefix for backend in backends
+                 if backend.stats is not None)
+    for metric, value in chef_stats.iteritems():
+      if not (skip and metric.startswith(skip)):
+        out.emit(metric, ts, value)
+
+
+def main():
+  """collector main loop"""
 
-    sys.stdout.flush()
-    time.sleep(interval)
+  setup()
+  out = emitter.Emitter(heartbeat=DEDUP_HEARTBEAT)
+  sched = scheduler.Scheduler(INTERVAL)
+  for ts in sched:
+    with self_stats.cycle():
+      collect(out, ts)
+    self_stats.report(out, ts, sched.missed)
+    with self_stats.phase('flush'):
+      out.flush()
 
 if __name__ == '__main__':
   main()
@@ -8,52 +8,227 @@
 # Requires the Adafruit_Python_DHT Python library to be installed:
 # https://github.com/adafruit/Adafruit_Python_DHT.git
 #
-# This was written for use with Raspberry Pis and the DHT sensor connected to
-# the Pi via GPIO4 (pin 7), but can work with any GPIO by updating the 'gpio'
-# variable below.  This also works fine with the less-precise DHT11 sensor.
+# This was written for use with Raspberry Pis and DHT sensors connected to
+# the Pi via GPIO. Sensors are listed in etc/dht.conf, one per line with a
+# name, GPIO pin and sensor type. This also works fine with the less-precise
+# DHT11 sensor. Without a config file, a single DHT22 named 'wall' on GPIO4
+# (pin 7) is read.
+#
+# Each sensor is read in its own worker, retrying failed reads no more than
+# once every MIN_READ_SPACING seconds, until READ_TIMEOUT runs out. Whatever
+# sensors have answered by then are reported, so one flaky sensor can't hold
+# up the rest. A sensor still being read from the last cycle is skipped.
 #
 # Emitted metrics, with sensor=X as a tag:
 #   dht.temp_c         Temperature in Celcius (C)
 #   dht.temp_f         Temperature in Fahrenheit (F)
 #   dht.humid          Humidity, percentage
+#   dht.dew_point_c    Dew point in Celcius (C)
+#   dht.heat_index_c   Heat index (apparent temperature) in Celcius (C)
 #
-# By: Bryan Wann
+# Everything but temp_c and humid is worked out by DERIVED, for all of a
+# cycle's readings at once (see collectors/lib/derived.py). Humidity
+# readings over 100% aren't sent, nor is anything derived from them.
 #
-# TODO:
-# - Make this support reading multiple sensors from the same Raspberry Pi
+# plus tcollector.self.*, see collectors/lib/selfstats.py. Sensors that
+# didn't answer in time count as errors.
+#
+# By: Bryan Wann
 #
 # vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
 
 import Adafruit_DHT
+import os
 import sys
+import threading
 import time
+import Queue
+from collectors.lib import derived
+from collectors.lib import emitter
+from collectors.lib import scheduler
+from collectors.lib import selfstats
 
-# DHT22/AM2302 sensor, GPIO4 pin on Raspberry Pi
-gpio = 4
-# Sensor name, emitted as sensor=X as a tag
-sensor = 'wall'
+# GPIO access needs root
+USER = "root"
+INTERVAL = 30
 
-def main():
+# Used when there's no etc/dht.conf: DHT22/AM2302 sensor, GPIO4 pin on
+# Raspberry Pi, emitted as sensor=wall
+DEFAULT_SENSORS = [('wall', 4, 22)]
+
+# Note: Adafruit_DHT library doesn't support reads faster than
+# every 2 seconds
+MIN_READ_SPACING = 2
+# Seconds each cycle waits for sensors to answer
+READ_TIMEOUT = 20
+# Most sensors read at the same time
+MAX_WORKERS = 4
+
+SENSOR_TYPES = {
+    '11': Adafruit_DHT.DHT11,
+    '22': Adafruit_DHT.DHT22,
+    '2302': Adafruit_DHT.AM2302,
+}
+
+DERIVED = (
+    ('temp_f', derived.c_to_f, ('temp_c',)),
+    ('dew_point_c', derived.dew_point_c, ('temp_c', 'humid')),
+    ('heat_index_c', derived.heat_index_c, ('temp_c', 'humid')),
+)
+LIMITS = {
+    'humid': (0, 100),
+}
+# Fields sent for each sensor, in order
+FIELDS = ('temp_c', 'temp_f', 'humid', 'dew_point_c', 'heat_index_c')
+pipeline = derived.Pipeline(DERIVED, LIMITS)
+
+# Configured sensors, the queue of reads for the workers, and the condition
+# they signal a finished read on
+sensors = []
+work = Queue.Queue()
+done = threading.Condition()
+
+self_stats = selfstats.SelfStats('dht_temp')
+
+
+class Sensor(object):
+    """One DHT sensor and when it was last read."""
+
+    def __init__(self, name, gpio, model):
+        self.name = name
+        self.gpio = gpio
+        self.model = model
+        self.last_read = 0
+        self.busy = False
+
+
+def load_sensors(config_file):
+    """Returns the Sensors listed in config_file, skipping bad lines."""
+
+    sensors = []
+    for lineno, line in enumerate(open(config_file), 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        if len(fields) not in (2, 3) or not fields[1].isdigit():
+            print >> sys.stderr, ("%s:%d: expected <name> <gpio> [<type>]"
+                                  % (config_file, lineno))
+            continue
+        model = fields[2] if len(fields) == 3 else '22'
+        if model not in SENSOR_TYPES:
+            print >> sys.stderr, ("%s:%d: unknown sensor type %s"
+                                  % (config_file, lineno, model))
+            continue
+        sensors.append(Sensor(fields[0], int(fields[1]),
+                              SENSOR_TYPES[model]))
+    return sensors
 
-    # Note: Adafruit_DHT library doesn't support reads faster than
-    # every 2 seconds
-    interval = 30
+
+def read_sensor(sensor, deadline):
+    """Reads a sensor, retrying no faster than MIN_READ_SPACING until it
+    answers or the deadline passes. Returns (humidity, temp_c) or None.
+    """
+
+    while True:
+        wait = sensor.last_read + MIN_READ_SPACING - time.time()
+        if time.time() + max(wait, 0) >= deadline:
+            return None
+        if wait > 0:
+            time.sleep(wait)
+        sensor.last_read = time.time()
+        humidity, temp_c = Adafruit_DHT.read(sensor.model, sensor.gpio)
+        if humidity is not None and temp_c is not None:
+            return humidity, temp_c
+
+
+def worker():
+    """Reads queued sensors, filling in each cycle's results."""
 
     while True:
-        ts = int(time.time())
+        sensor, deadline, results = work.get()
+        try:
+            result = read_sensor(sensor, deadline)
+        except Exception, e:
+            print >> sys.stderr, ("reading %s on GPIO%d failed: %s"
+                                  % (sensor.name, sensor.gpio, e))
+            result = None
+        with done:
+            sensor.busy = False
+            if result is not None:
+                results[sensor] = result
+            done.notify()
+
+
+def setup():
+    """Loads the sensor list and starts the read workers."""
+
+    config_file = (os.path.dirname(os.path.abspath(__file__)) +
+                   "/../etc/dht.conf")
+    if os.path.exists(config_file):
+        sensors.extend(load_sensors(config_file))
+    else:
+        sensors.extend(Sensor(name, gpio, SENSOR_TYPES[str(model)])
+                       for name, gpio, model in DEFAULT_SENSORS)
+    if not sensors:
+        print >> sys.stderr, "no sensors configured in %s" % config_file
+        sys.exit(13)
 
-        humidity, temp_c = Adafruit_DHT.read_retry(22, gpio)
+    for _ in range(min(MAX_WORKERS, len(sensors))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
 
-        if temp_c:
-            temp_f = 9.0/5.0 * temp_c + 32
-            print "dht.temp_c %s %.2f sensor=%s" % (ts, temp_c, sensor)
-            print "dht.temp_f %s %.2f sensor=%s" % (ts, temp_f, sensor)
 
-        if humidity <= 100:
-            print "dht.humid %s %.2f sensor=%s" % (ts, humidity, sensor)
+def collect(out, ts):
+    """Reads every sensor not still busy, reports those back in time."""
+
+    deadline = time.time() + READ_TIMEOUT
+    results = {}
+    queued = []
+    with self_stats.phase('read'), done:
+        for sensor in sensors:
+            if sensor.busy:
+                continue
+            sensor.busy = True
+            queued.append(sensor)
+            work.put((sensor, deadline, results))
+
+        while any(sensor.busy for sensor in queued):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            done.wait(remaining)
+        finished = results.items()
+    self_stats.error(len(queued) - len(finished))
+
+    if not finished:
+        return
+
+    # one row per sensor
+    with self_stats.phase('derive'):
+        batch = pipeline.apply({
+            'humid': [humidity for _, (humidity, _) in finished],
+            'temp_c': [temp_c for _, (_, temp_c) in finished],
+        })
+    for row, (sensor, _) in enumerate(finished):
+        tags = {'sensor': sensor.name}
+        for field in FIELDS:
+            value = batch[field][row]
+            if value == value:
+                out.emit('dht.' + field, ts, value, tags, '%.2f')
+
+
+def main():
 
-        sys.stdout.flush()
-        time.sleep(interval)
+    setup()
+    out = emitter.Emitter()
+    sched = scheduler.Scheduler(INTERVAL)
+    for ts in sched:
+        with self_stats.cycle():
+            collect(out, ts)
+        self_stats.report(out, ts, sched.missed)
+        with self_stats.phase('flush'):
+            out.flush()
 
 if __name__ == '__main__':
     sys.exit(main())
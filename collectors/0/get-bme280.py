@@ -16,12 +16,26 @@
 # This will not work with the BME680 sensor, as it uses a different Python
 # library.
 #
+# The sensor is read SAMPLE_RATE times a second in the background, and every
+# interval the samples are boiled down to their mean, which is sent under the
+# metric names below, plus the AGGREGATES listed, sent as <metric>.<agg>
+# (e.g. bme280.pressure_hpa.p95). Only the raw readings are sampled; the
+# rest are worked out from the interval's samples in one go by DERIVED (see
+# collectors/lib/derived.py), and humidity readings over 100% are dropped
+# along with whatever is derived from them.
+#
 # Emitted metrics:
 #   bme280.temp_c         Temperature in Celcius (C)
 #   bme280.temp_f         Temperature in Fahrenheit (F)
 #   bme280.pressure_hpa   Barometric pressure in Hectopascals (hPa)
 #   bme280.pressure_inch  Barometric pressure in Inch of Mercury (inHg)
 #   bme280.humid           Humidity, percentage
+#   bme280.dew_point_c    Dew point in Celcius (C)
+#   bme280.heat_index_c   Heat index (apparent temperature) in Celcius (C)
+#   bme280.samples        Samples taken this interval
+#   bme280.read_errors    Failed sensor reads (counter)
+#   tcollector.self.*     Cycle times, points, errors; see
+#                         collectors/lib/selfstats.py
 #
 # By: Bryan Wann
 #
@@ -30,44 +44,112 @@
 import bme280
 import smbus2
 import sys
-import time
+from collectors.lib import derived
+from collectors.lib import emitter
+from collectors.lib import privileges
+from collectors.lib import sampling
+from collectors.lib import scheduler
+from collectors.lib import selfstats
+
+# The I2C bus is opened when this is loaded, so reads keep working after
+# we drop privileges to this user
+USER = "nobody"
+INTERVAL = 15
 
 # I2C port and address
 port = 1
 address = 0x77
 bus = smbus2.SMBus(port)
 
+# Sensor reads per second, and which aggregates to send besides the mean
+SAMPLE_RATE = 1.0
+AGGREGATES = ('min', 'max', 'stddev', 'p95')
+
+# Send a reading only when it moved more than its deadband from the last one
+# sent, or every DEDUP_HEARTBEAT cycles regardless. 0 sends every reading,
+# and leaves DEADBANDS unused; they only apply with a non-zero heartbeat.
+DEDUP_HEARTBEAT = 0
+DEADBANDS = {
+    'bme280.temp_c': 0.05,
+    'bme280.temp_f': 0.09,
+    'bme280.pressure_hpa': 0.1,
+    'bme280.pressure_inch': 0.003,
+    'bme280.humid': 0.2,
+    'bme280.dew_point_c': 0.05,
+    'bme280.heat_index_c': 0.05,
+}
+
+DERIVED = (
+    ('temp_f', derived.c_to_f, ('temp_c',)),
+    ('pressure_inch', derived.hpa_to_inhg, ('pressure_hpa',)),
+    ('dew_point_c', derived.dew_point_c, ('temp_c', 'humid')),
+    ('heat_index_c', derived.heat_index_c, ('temp_c', 'humid')),
+)
+LIMITS = {
+    'humid': (0, 100),
+}
+pipeline = derived.Pipeline(DERIVED, LIMITS)
+
 calibration_params = bme280.load_calibration_params(bus, address)
 
-def main():
+self_stats = selfstats.SelfStats('get-bme280')
 
-    interval = 15
+def read_sensor():
+    """Takes one sample, returns a dict of raw field to value."""
 
-    while True:
-        ts = int(time.time())
+    data = bme280.sample(bus, address, calibration_params)
+    if not data:
+        raise IOError("no data from sensor at %#x" % address)
 
-        data = bme280.sample(bus, address, calibration_params)
+    # every field every time, so the sample buffers stay row aligned
+    return {
+        'temp_c': data.temperature,
+        'pressure_hpa': data.pressure,
+        'humid': data.humidity,
+    }
 
-        if data:
-            temp_c = data.temperature
-            temp_f = 9.0/5.0 * temp_c + 32
+sampler = sampling.Sampler(
+    read_sensor, ('temp_c', 'pressure_hpa', 'humid'),
+    rate=SAMPLE_RATE, size=int(SAMPLE_RATE * INTERVAL * 2) + 1)
 
-            print "bme280.temp_c %s %.2f" % (ts, temp_c)
-            print "bme280.temp_f %s %.2f" % (ts, temp_f)
+def setup():
+    sampler.start()
 
-            print "bme280.pressure_hpa %s %.2f" % (ts, data.pressure)
-            print "bme280.pressure_inch %s %.2f" % (ts, data.pressure / 33.87)
+def collect(out, ts):
+    """Sends the aggregates of the samples taken since the last call"""
 
-            humidity = data.humidity
-            if humidity <= 100:
-                print "bme280.humid %s %.2f" % (ts, humidity)
+    samples = sampler.drain()
+    with self_stats.phase('derive'):
+        batch = pipeline.apply(samples)
+    with self_stats.phase('aggregate'):
+        for field, column in sorted(batch.iteritems()):
+            values = derived.valid(column)
+            if not values:
+                continue
+            stats = sampling.aggregate(values)
+            metric = 'bme280.' + field
+            out.emit(metric, ts, stats['mean'], fmt='%.2f')
+            for agg in AGGREGATES:
+                out.emit(metric + '.' + agg, ts, stats[agg], fmt='%.2f')
 
-        else:
-            sleep(2)
-            next
+    out.emit('bme280.samples', ts,
+             max(len(values) for values in samples.values())
+             if samples else 0)
+    out.emit('bme280.read_errors', ts, sampler.errors)
+    self_stats.set('errors', sampler.errors)
+
+def main():
 
-        sys.stdout.flush()
-        time.sleep(interval)
+    privileges.drop_privileges(USER)
+    setup()
+    out = emitter.Emitter(heartbeat=DEDUP_HEARTBEAT, deadbands=DEADBANDS)
+    sched = scheduler.Scheduler(INTERVAL)
+    for ts in sched:
+        with self_stats.cycle():
+            collect(out, ts)
+        self_stats.report(out, ts, sched.missed)
+        with self_stats.phase('flush'):
+            out.flush()
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -7,12 +7,36 @@
 # https://github.com/scottjw/subfact_pi_ina219
 # along with 2's compliment patching.
 #
+# Each module gets one driver for the life of the process, and each of its
+# registers is read once per sample. SAMPLES samples per module are taken
+# in the background, evenly spaced over each interval; the mean goes out
+# under the metric names below, and with more than one sample the min and
+# max go out as <metric>.min/.max, so short spikes on the solar and battery
+# rails aren't lost between polls.
+#
+# Emitted metrics, with address=X and name=X as tags:
+#   ina219.shunt_voltage   Shunt voltage, millivolts
+#   ina219.bus_voltage     Bus voltage, volts
+#   ina219.voltage         Supply voltage (bus + shunt), volts
+#   ina219.current         Current, milliamps
+#   ina219.power           Power delivered to the load (bus voltage times
+#                          current), watts
+#
+# voltage and power are worked out by DERIVED for all of an interval's
+# samples at once, see collectors/lib/derived.py.
+#
+# plus tcollector.self.*, with failed module reads counted as errors, see
+# collectors/lib/selfstats.py.
+#
 # vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
 
-import os
-import pwd
 import sys
-import time
+from collectors.lib import derived
+from collectors.lib import emitter
+from collectors.lib import privileges
+from collectors.lib import sampling
+from collectors.lib import scheduler
+from collectors.lib import selfstats
 from lib.Subfact_ina219 import INA219
 
 # Human-readable label to i2c address mappings
@@ -23,46 +47,122 @@ ina219_modules = {
 }
 
 USER = "nobody"
-interval = 30
+INTERVAL = 30
+
+# Samples per module per interval
+SAMPLES = 5
+
+# i2c address -> INA219 driver. Creating one recalibrates the module, so
+# they're kept around.
+drivers = {}
+
+self_stats = selfstats.SelfStats('ina219_power')
+
+# Readings tcollector isn't ready for are kept in this file and sent in
+# order once it catches up, rather than holding up the collector. None
+# blocks instead. See collectors/lib/emitter.py.
+SPOOL = "/var/tmp/tcollector-ina219_power.spool"
+
+# Send a reading only when it moved more than its deadband from the last one
+# sent, or every DEDUP_HEARTBEAT cycles regardless. 0 sends every reading,
+# and leaves DEADBANDS unused; they only apply with a non-zero heartbeat.
+DEDUP_HEARTBEAT = 0
+DEADBANDS = {
+    'ina219.shunt_voltage': 0.05,  # mV
+    'ina219.voltage': 0.005,       # V
+    'ina219.bus_voltage': 0.005,   # V
+    'ina219.current': 1.0,         # mA
+    'ina219.power': 0.01,          # W
+}
 
-def drop_privileges():
+DERIVED = (
+    ('voltage', derived.supply_voltage, ('bus_voltage', 'shunt_voltage')),
+    ('power', derived.power_w, ('bus_voltage', 'current')),
+)
+# Fields read from each module, sampled in the background
+RAW_FIELDS = ('shunt_voltage', 'bus_voltage', 'current')
+# Fields sent for each module, in order
+FIELDS = ('shunt_voltage', 'voltage', 'bus_voltage', 'current', 'power')
+pipeline = derived.Pipeline(DERIVED)
 
-    if USER == 'root':
-        return
+def get_driver(address):
+    """Returns the INA219 driver for an address, creating it once."""
 
     try:
-        ent = pwd.getpwnam(USER)
+        return drivers[address]
     except KeyError:
-        return
+        ina = drivers[address] = INA219(address=int(address, 16))
+        return ina
 
-    if os.getuid() != 0:
-        return
-    os.setgid(ent.pw_gid)
-    os.setuid(ent.pw_uid)
+def read_sample(ina):
+    """Reads each register once, returns (shunt mV, bus V, current mA)."""
 
-def main():
+    return (ina.getShuntVoltage_mV(), ina.getBusVoltage_V(),
+            ina.getCurrent_mA())
 
-    drop_privileges()
-    sys.stdin.close()
+def read_modules():
+    """Takes one sample of every module, so each round of samples is from
+    about the same moment. Returns a dict of (module name, field) to value,
+    leaving out modules that couldn't be read.
+    """
+
+    sample = {}
+    for name, address in ina219_modules.items():
+        try:
+            shunt, bus, current = read_sample(get_driver(address))
+        except IOError, e:
+            print >> sys.stderr, ("i2c read of %s (%s) failed: %s"
+                                  % (name, address, e))
+            self_stats.error()
+            continue
+        sample[name, 'shunt_voltage'] = shunt
+        sample[name, 'bus_voltage'] = bus
+        sample[name, 'current'] = current
+    return sample
+
+sampler = sampling.Sampler(
+    read_modules, [(name, field) for name in ina219_modules
+                   for field in RAW_FIELDS],
+    rate=SAMPLES / float(INTERVAL), size=SAMPLES * 2 + 1)
+
+def setup():
+    sampler.start()
 
-    while True:
-        ts = int(time.time())
+def collect(out, ts):
+    """Sends the stats of the samples taken since the last call"""
 
-        for name, address in ina219_modules.items():
-            ina = INA219(address=int(address, 16))
+    def emit_stat(metric, values, tags):
+        out.emit(metric, ts, sum(values) / len(values), tags, '%.3f')
+        if len(values) > 1:
+            out.emit(metric + '.min', ts, min(values), tags, '%.3f')
+            out.emit(metric + '.max', ts, max(values), tags, '%.3f')
 
-            print ("ina219.shunt_voltage %d %.3f address=%s name=%s"
-                   % (ts, ina.getShuntVoltage_mV(), address, name))
-            print ("ina219.voltage %d %.3f address=%s name=%s"
-                   % (ts, (ina.getBusVoltage_V() +
-                           ina.getShuntVoltage_mV() / 1000), address, name))
-            print ("ina219.bus_voltage %d %.3f address=%s name=%s"
-                   % (ts, ina.getBusVoltage_V(), address, name))
-            print ("ina219.current %d %.3f address=%s name=%s"
-                   % (ts, ina.getCurrent_mA(), address, name))
+    samples = sampler.drain()
+    for name, address in ina219_modules.items():
+        if (name, 'current') not in samples:
+            continue
+        tags = {'address': address, 'name': name}
 
-        sys.stdout.flush()
-        time.sleep(interval)
+        with self_stats.phase('derive'):
+            batch = pipeline.apply(dict((field, samples[name, field])
+                                        for field in RAW_FIELDS))
+        for field in FIELDS:
+            emit_stat('ina219.' + field, batch[field], tags)
+
+def main():
+
+    privileges.drop_privileges(USER)
+    sys.stdin.close()
+    setup()
+    out = emitter.Emitter(heartbeat=DEDUP_HEARTBEAT, deadbands=DEADBANDS,
+                          spool=SPOOL)
+    sched = scheduler.Scheduler(INTERVAL)
+    for ts in sched:
+        with self_stats.cycle():
+            collect(out, ts)
+        self_stats.report(out, ts, sched.missed)
+        with self_stats.phase('flush'):
+            out.flush()
 
 if __name__ == "__main__":
     main()
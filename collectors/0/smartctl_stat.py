@@ -4,10 +4,11 @@
 # smartctl_stats.py
 # 
 # Grabs SMART vendor attributes for a disk/device and sends the raw value
-# to TSD, tagged with the device name. This is a simple version and only
-# collects data for a handful of predefined drives. Expanding this to
-# auto-detect a list of drives and/or try to massage which value/raw value
-# to use for a given drive is an exercise left to the user. :)
+# to TSD, tagged with the device name. Disks are found in /sys/block (or
+# with `smartctl --scan` where there's no sysfs), and the list is re-read
+# every cycle so hotplugged disks come and go on their own. smartctl runs
+# for up to MAX_PROCS disks at once so a big shelf still fits the interval.
+# Disks in standby are skipped rather than spun up, via `smartctl -n standby`.
 #
 # Example attributes recorded (these can vary between manuf/model)
 # smart.smartctl.raw_read_error_rate
@@ -26,91 +27,383 @@
 # smart.smartctl.reallocated_event_count
 # ...
 #
+# ATA attributes also get their normalized VALUE and THRESH, as
+# smart.smartctl.<attribute>.normalized and .threshold. Raw values are
+# reduced to the number they start with, so "34 (Min/Max 20/45)" is sent
+# as 34. NVMe drives report their health log fields, e.g.
+# smart.smartctl.media_errors.
+#
+# smartctl's JSON output (-j, smartctl 7.0+) is parsed when it's available.
+# Older versions fall back to parsing the text table.
+#
+# Counters in RATE_COUNTERS are also sent as per-second rates, e.g.
+# smart.smartctl.power_cycle_count_per_s, worked out here rather than with
+# rate() queries on the TSD. The last value of each is kept in RATE_STATE,
+# so rates pick up where they left off after a restart, and a counter that
+# went backwards is taken as reset (see collectors/lib/emitter.py).
+#
+# smart.smartctl.devices          disks found this cycle
+# smart.smartctl.devices_standby  disks skipped because they're spun down
+# smart.smartctl.devices_failed   disks smartctl failed on or that didn't
+#                                 finish within the interval
+# tcollector.self.*               time spent running smartctl and parsing
+#                                 its output, see collectors/lib/selfstats.py
+#
 # Written by: Bryan Wann <bwann [at] wann.net>
 #
 
+import json
 import os
+import re
 import subprocess
 import sys
+import threading
 import time
+import Queue
+from collectors.lib import emitter
+from collectors.lib import scheduler
+from collectors.lib import selfstats
 
+SMARTCTL = "/usr/sbin/smartctl"
+# smartctl needs root to open the disks
+USER = "root"
+INTERVAL = 60
+# How many smartctl processes to run at once
+MAX_PROCS = 8
+# Block devices that never have SMART data
+SKIP_PREFIXES = ("loop", "ram", "zram", "dm-", "md", "sr", "fd", "nbd")
+# Send a value only when it changed, or every DEDUP_HEARTBEAT cycles
+# regardless. 0 sends every value every cycle.
+DEDUP_HEARTBEAT = 0
+# Attributes (ATA) and health log fields (NVMe) that count up
+RATE_COUNTERS = ("power_cycle_count", "start_stop_count", "load_cycle_count",
+                 "udma_crc_error_count", "power_cycles", "unsafe_shutdowns",
+                 "data_units_read", "data_units_written", "host_reads",
+                 "host_writes")
+RATES = dict(("smart.smartctl." + name, "smart.smartctl." + name + "_per_s")
+             for name in RATE_COUNTERS)
+RATE_STATE = "/var/tmp/tcollector-smartctl_stat.rates"
+# Ask for JSON output (smartctl 7.0 and up). Turned off on the first run
+# if this smartctl doesn't know -j, and the text parser is used instead.
+USE_JSON = True
+
+# Text output columns we need, located by name in the ID# header line
+LAYOUT_COLUMNS = ("ATTRIBUTE_NAME", "VALUE", "THRESH", "RAW_VALUE")
+# model -> column indexes of LAYOUT_COLUMNS in its smartctl -A output
+layouts = {}
+
+LEADING_INT = re.compile(r"\d+")
+
+# Disks found on the last cycle
+devices = []
+
+# device -> Popen for smartctl runs still going. A disk that hangs smartctl
+# in uninterruptible sleep can outlive the kill, so it's skipped until its
+# last run has exited rather than stacking up another stuck process.
+running = {}
+running_lock = threading.Lock()
+
+self_stats = selfstats.SelfStats('smartctl_stat')
+
+
+def discover_devices():
+    """Returns the sorted list of /dev paths of physical disks."""
+
+    try:
+        names = os.listdir("/sys/block")
+    except OSError:
+        return scan_devices()
+
+    devices = []
+    for name in names:
+        if name.startswith(SKIP_PREFIXES):
+            continue
+        # virtual block devices have no backing device
+        if not os.path.exists(os.path.join("/sys/block", name, "device")):
+            continue
+        devices.append("/dev/" + name.replace("!", "/"))
+    return sorted(devices)
+
+
+def scan_devices():
+    """Asks smartctl for the devices it knows about."""
+
+    try:
+        scan = subprocess.Popen([SMARTCTL, "--scan"], stdout=subprocess.PIPE)
+    except OSError, e:
+        print >> sys.stderr, "smartctl --scan failed: %s" % e
+        return []
+    stdout, _ = scan.communicate()
+
+    devices = []
+    for line in stdout.split("\n"):
+        fields = line.split()
+        if fields and fields[0].startswith("/dev/"):
+            devices.append(fields[0])
+    return sorted(devices)
+
+
+def run_smartctl(device):
+    """Runs smartctl for one device, returns (returncode, stdout)."""
+
+    args = [SMARTCTL, "-n", "standby", "-i", "-A"]
+    if USE_JSON:
+        args.append("-j")
+    smartctl = subprocess.Popen(args + [device], stdout=subprocess.PIPE)
+    with running_lock:
+        running[device] = smartctl
+    try:
+        stdout, _ = smartctl.communicate()
+    finally:
+        with running_lock:
+            del running[device]
+    return smartctl.returncode, stdout
+
+
+def run_all(devices, deadline):
+    """Runs smartctl on every device, MAX_PROCS at a time. Returns a dict
+    of device to (returncode, stdout) for the runs done by the deadline.
+    Runs still going at the deadline are killed, and devices whose last
+    run hasn't exited yet are skipped.
+    """
+
+    work = Queue.Queue()
+    with running_lock:
+        stuck = [device for device in devices if device in running]
+    for device in devices:
+        if device in stuck:
+            print >> sys.stderr, ("smartctl %s still running since last time,"
+                                  " skipping" % device)
+        else:
+            work.put(device)
+
+    results = {}
+    lock = threading.Lock()
+
+    def worker():
+        while time.time() < deadline:
+            try:
+                device = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = run_smartctl(device)
+            except OSError, e:
+                print >> sys.stderr, "smartctl %s failed: %s" % (device, e)
+                continue
+            with lock:
+                results[device] = result
+
+    threads = []
+    for _ in range(min(MAX_PROCS, len(devices))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join(max(0, deadline - time.time()))
+
+    with running_lock:
+        late = running.items()
+    for device, smartctl in late:
+        if device in stuck:
+            continue
+        print >> sys.stderr, "smartctl %s timed out, killing it" % device
+        try:
+            smartctl.kill()
+        except OSError:
+            pass  # already exited
+
+    with lock:
+        return dict(results)
 
-def main():
-    """smartctl_stat main loop"""
 
-    # for now only worry about the usual root drives
-    # figure out complicated auto detection later
-    devices = ["/dev/sda", "/dev/sdb"]
+def leading_int(text):
+    """Returns the number at the start of a raw value string, such as 34
+    for "34 (Min/Max 20/45)" or 26297 for "26297h+43m+40.621s".
+    """
 
-    interval = 60
+    m = LEADING_INT.match(text)
+    if m:
+        return int(m.group(0))
+    return None
 
-    while True:
-        ts = int(time.time())
-        tags = {}
 
-        for device in devices:
-            if not os.path.exists(device):
+def parse_json(stdout):
+    """Yields (name, raw, normalized, threshold) for each attribute in
+    smartctl -j output. NVMe health log entries have no normalized or
+    threshold value. Raises ValueError if stdout isn't JSON.
+    """
+
+    data = json.loads(stdout)
+
+    for attribute in data.get("ata_smart_attributes", {}).get("table", []):
+        name = str(attribute["name"]).lower()
+        if name == "unknown_attribute":
+            continue
+        raw = attribute.get("raw", {})
+        # packed values like temperature min/max are only readable as text
+        value = leading_int(raw.get("string", ""))
+        if value is None:
+            value = raw.get("value")
+        yield (name, value, attribute.get("value"),
+               attribute.get("thresh"))
+
+    health = data.get("nvme_smart_health_information_log", {})
+    for name, value in sorted(health.iteritems()):
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            yield str(name), value, None, None
+
+
+def parse_text(stdout):
+    """Yields (name, raw, normalized, threshold) for each attribute in
+    smartctl -i -A text output. Column positions are looked up in the
+    ID# header once per device model and cached in layouts.
+    """
+
+    model = None
+    layout = None
+    in_attributes = False
+
+    for line in stdout.split("\n"):
+
+        if not in_attributes:
+            if line.startswith(("Device Model:", "Model Number:",
+                                "Product:")):
+                model = line.split(":", 1)[1].strip()
                 continue
 
-            smartctl = subprocess.Popen(
-                       ["/usr/sbin/smartctl", "-A", device],
-                       stdout=subprocess.PIPE)
-            stdout, _ = smartctl.communicate()
-            
-            
-            if smartctl:
-                name_index = None
-                value_index = None
-                raw_value_index = None
-                in_attributes = None
-
-                for line in stdout.split("\n"):
-
-                    # truncate '/dev/'
-                    tags['device'] = (device.replace("/dev/", "")
-                                      .replace("/", "_"))
-
-                    # figure out which column contains our key names and values
-                    if line.startswith("ID#"):
-                        in_attributes = True
-                        for idx, val in enumerate(line.split()):
-                            if val == "ATTRIBUTE_NAME":
-                                name_index = idx
-                            if val == "VALUE":
-                                value_index = idx
-                            if val == "RAW_VALUE":
-                                raw_value_index = idx
-                        continue
-
-                    if in_attributes:
-                        # blank line, we've seen all the attributes
-                        if line == "":
-                          in_attributes = False
-                          continue
-
-                        attribute = line.split()
-                        name = attribute[name_index].lower()
-                        value = attribute[raw_value_index]
-
-                        if name == "unknown_attribute":
-                          continue
-
-                        all_tags = " ".join("%s=%s" % (name, value)
-                                      for name, value in tags.iteritems())
-                        print("smart.smartctl.%s %d %s %s"
-                              % (name, ts, value, all_tags))
-                    else:
-                        continue
-
-
-            else:
-                # In modes other than -A, return value could change based on
-                # the drive health
-                print >> sys.stderr, ("smartctl -A %s returned %r"
-                                      % device, smartctl.returncode)
-
-        sys.stdout.flush()
-        time.sleep(interval)
+            # figure out which column contains our key names and values
+            if line.startswith("ID#"):
+                in_attributes = True
+                layout = layouts.get(model)
+                if layout is None:
+                    columns = line.split()
+                    layout = tuple(columns.index(column)
+                                   if column in columns else None
+                                   for column in LAYOUT_COLUMNS)
+                    if model is not None:
+                        layouts[model] = layout
+                # no use going on without names and values
+                if layout[0] is None or layout[3] is None:
+                    return
+            continue
+
+        # blank line, we've seen all the attributes
+        if line == "":
+            in_attributes = False
+            continue
+
+        name_index, value_index, thresh_index, raw_value_index = layout
+        attribute = line.split()
+        if len(attribute) <= raw_value_index:
+            continue
+        name = attribute[name_index].lower()
+
+        if name == "unknown_attribute":
+            continue
+
+        # RAW_VALUE is the last column, and may have spaces in it
+        value = leading_int(" ".join(attribute[raw_value_index:]))
+        if value is None:
+            continue
+
+        normalized = threshold = None
+        if value_index is not None:
+            normalized = leading_int(attribute[value_index])
+        if thresh_index is not None:
+            threshold = leading_int(attribute[thresh_index])
+        yield name, value, normalized, threshold
+
+
+def parse_smartctl(stdout):
+    """Parses smartctl output with whichever parser fits it."""
+
+    if stdout.lstrip().startswith("{"):
+        return parse_json(stdout)
+    return parse_text(stdout)
+
+
+def collect(out, ts):
+    """Reads every disk that's awake"""
+
+    global USE_JSON, devices
+
+    with self_stats.phase('discover'):
+        found = discover_devices()
+    if found != devices:
+        print >> sys.stderr, ("smartctl devices now: %s"
+                              % " ".join(found))
+        devices = found
+
+    with self_stats.phase('smartctl'):
+        results = run_all(devices, time.time() + INTERVAL * 0.9)
+
+    standby = 0
+    failed = len(devices) - len(results)
+    for device in devices:
+        if device not in results:
+            continue
+        returncode, stdout = results[device]
+
+        # -n standby exits with 2 without touching a sleeping disk
+        if "STANDBY" in stdout or "SLEEP" in stdout:
+            standby += 1
+            continue
+
+        if USE_JSON and "UNRECOGNIZED OPTION" in stdout:
+            print >> sys.stderr, ("smartctl has no JSON output, "
+                                  "parsing text from now on")
+            USE_JSON = False
+            failed += 1
+            continue
+
+        # Bits 0 and 1 mean smartctl couldn't parse its arguments or
+        # open the device. Higher bits are about the drive's health and
+        # still come with attributes.
+        if returncode & 3:
+            print >> sys.stderr, ("smartctl -A %s returned %r"
+                                  % (device, returncode))
+            failed += 1
+            continue
+
+        # truncate '/dev/'
+        tags = {'device': device.replace("/dev/", "").replace("/", "_")}
+        try:
+            with self_stats.phase('parse'):
+                for name, raw, normalized, threshold in parse_smartctl(
+                        stdout):
+                    metric = "smart.smartctl." + name
+                    out.emit(metric, ts, raw, tags)
+                    if normalized is not None:
+                        out.emit(metric + ".normalized", ts, normalized,
+                                 tags)
+                    if threshold is not None:
+                        out.emit(metric + ".threshold", ts, threshold, tags)
+        except (ValueError, KeyError), e:
+            print >> sys.stderr, ("can't parse smartctl output for %s: %s"
+                                  % (device, e))
+            failed += 1
+
+    out.emit("smart.smartctl.devices", ts, len(devices))
+    out.emit("smart.smartctl.devices_standby", ts, standby)
+    out.emit("smart.smartctl.devices_failed", ts, failed)
+    self_stats.error(failed)
+
+
+def main():
+    """smartctl_stat main loop"""
+
+    out = emitter.Emitter(heartbeat=DEDUP_HEARTBEAT, rates=RATES,
+                          rate_state=RATE_STATE)
+    sched = scheduler.Scheduler(INTERVAL)
+    for ts in sched:
+        with self_stats.cycle():
+            collect(out, ts)
+        self_stats.report(out, ts, sched.missed)
+        with self_stats.phase('flush'):
+            out.flush()
 
 if __name__ == "__main__":
     main()
@@ -6,6 +6,17 @@
 #
 # insteon.imeter.watt   current watt measurement
 # insteon.imeter.total  total watts (counter)
+# insteon.imeter.wh_rate  rise in total per hour since the device's last
+#                       reading, i.e. watt-hours per hour; the last total
+#                       is kept in RATE_STATE across restarts, and a total
+#                       that went down is taken as a reset of the meter
+# insteon.imeter.cycle_time_s   seconds taken to poll every device
+# insteon.imeter.polls_dropped  polls that failed or didn't fit the interval
+# insteon.imeter.poll_interval_s  seconds until a controller's next poll
+# insteon.http.*                connection reuse and request latency per
+#                               controller, see collectors/lib/httpclient.py
+# tcollector.self.*             cycle and phase times, points, errors; see
+#                               collectors/lib/selfstats.py
 #
 # Tags:
 # controller=           Hostname/IP address of SmartLinc controller
@@ -22,6 +33,25 @@
 # SmartLinc for iMeter power readings. This also provides a resetable
 # "accumulated" power value which is basically a counter of watts.
 #
+# The controller queues the modem messages it sees in one small response
+# buffer, read back as hex from buffstatus.xml. Status commands go out to
+# BATCH_SIZE devices at a time and the buffer is read once for the lot. It's
+# scanned for every iMeter status reply, and each reply is matched to the
+# device that sent it, so replies to other commands or left over from
+# earlier ones don't get mixed up with ours.
+#
+# Each controller is polled every INTERVAL seconds while it answers quickly.
+# A slow one is polled less often, so it spends no more than POLL_BUDGET of
+# its time answering us, and one that errors or times out is backed off,
+# doubling up to POLL_MAX, until it answers again (see AdaptiveInterval in
+# collectors/lib/scheduler.py).
+#
+# Controllers and devices are listed in etc/imeter.conf, one device per line
+# as "<controller> <device id>". Edits to it are picked up on the next cycle
+# without a restart (see collectors/lib/configwatch.py): devices added start
+# being polled, devices removed stop, and the rest keep their state. Lines
+# that don't parse are reported and skipped.
+#
 # It's worth noting this isn't the only way to do this. iMeters can also be
 # accessed by controllers with a USB interface, or some controllers can record
 # iMeter readings in CSVs. These cases aren't covered here.
@@ -30,31 +60,131 @@
 #
 # vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
 
+import binascii
 import os
+import re
+import struct
 import sys
 import time
-import pwd
-from urllib import urlopen
+import threading
+import Queue
+from collectors.lib import configwatch
+from collectors.lib import emitter
+from collectors.lib import httpclient
+from collectors.lib import privileges
+from collectors.lib import scheduler
+from collectors.lib import selfstats
 
 # If we're running as root and this user exists, we'll drop privileges
 USER = "nobody"
+INTERVAL = 15
+# How many SmartLinc controllers to poll at the same time. Devices behind a
+# single controller are polled a batch at a time, since the commands and
+# the buffstatus.xml read share the controller's one response buffer.
+MAX_CONCURRENCY = 4
+# Seconds to wait on a SmartLinc before giving up on a request
+HTTP_TIMEOUT = 10
+# Readings tcollector isn't ready for are kept in this file and sent in
+# order once it catches up, rather than holding up the next poll. None
+# blocks instead. See collectors/lib/emitter.py.
+SPOOL = "/var/tmp/tcollector-smartlinc_imeter.spool"
+# total is sent as a rate per hour too, see collectors/lib/emitter.py
+RATES = {'insteon.imeter.total': ('insteon.imeter.wh_rate', 3600)}
+RATE_STATE = "/var/tmp/tcollector-smartlinc_imeter.rates"
+# Longest a failing controller is left alone, and the share of time a
+# controller may spend answering us
+POLL_MAX = 300
+POLL_BUDGET = 0.25
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "etc", "imeter.conf")
+DEVICE_ID = re.compile(r'^[0-9A-Fa-f]{6}$')
+# Devices sent a status command before each buffstatus.xml read. The buffer
+# holds 101 bytes, and each device's command echo, ACK and status reply
+# take 45 of them.
+BATCH_SIZE = 2
+
+# Modem messages found in the response buffer, by the byte after their 0x02:
+# 0x62  echo of a command we sent: to(3) flags cmd1 cmd2 [data(14)] ack
+# 0x50  standard message received: from(3) to(3) flags cmd1 cmd2
+# 0x51  extended message received: from(3) to(3) flags cmd1 cmd2 data(14)
+SENT_SIZE = 9
+SENT_EXTENDED_SIZE = 23
+STANDARD_SIZE = 11
+# An iMeter status reply is an extended message with the current watts at
+# data bytes 6-7 and the accumulated total at 8-11, big endian
+STATUS_REPLY = struct.Struct('>2s3s3sBBB6sHI2s')
+EXTENDED_FLAG = 0x10
+IMETER_STATUS = 0x82
+# controller -> device ids behind it, from CONFIG_FILE
 imeters = {}
+# ConfigWatcher on CONFIG_FILE, set by setup()
+config = None
+# controller -> its AdaptiveInterval
+polls = {}
+# One kept-alive connection per controller, requests to it are serial anyway
+http = httpclient.HTTPClient(pool_size=1, idle_timeout=60,
+                             timeout=HTTP_TIMEOUT)
+self_stats = selfstats.SelfStats('smartlinc_imeter')
+# Controllers with a worker still running from an earlier cycle
+busy = set()
+busy_lock = threading.Lock()
 
-def drop_privileges():
-    try:
-        ent = pwd.getpwnam(USER)
-    except KeyError:
-        return
+def parse_buffstatus(body, devices):
+    """Scans a buffstatus.xml response for iMeter status replies from the
+    given devices, returns a dict of device id (upper case hex) to (watts,
+    total). The buffer isn't cleared between polls, so only a reply after
+    the latest echo of our command to a device is its answer this time;
+    anything older is a stale reading from an earlier poll.
+    """
 
-    if os.getuid() != 0:
-        return
+    start = body.find('<BS>')
+    end = body.find('</BS>', start)
+    if start < 0 or end < 0:
+        return {}
+    digits = body[start + 4:end]
+    try:
+        buf = binascii.unhexlify(digits[:len(digits) & ~1])
+    except TypeError:
+        return {}
 
-    os.setgid(ent.pw_gid)
-    os.setuid(ent.pw_uid)
+    wanted = set(device.upper() for device in devices)
+    # devices whose command echo we've passed
+    echoed = set()
+    readings = {}
+    size = len(buf)
+    i = buf.find('\x02')
+    while 0 <= i < size - 1:
+        kind = buf[i + 1]
+        if kind == '\x51' and i + STATUS_REPLY.size <= size:
+            (_, sender, _, flags, cmd1, _, _, watts, total,
+             _) = STATUS_REPLY.unpack_from(buf, i)
+            if flags & EXTENDED_FLAG and cmd1 == IMETER_STATUS:
+                sender = binascii.hexlify(sender).upper()
+                if sender in echoed:
+                    readings[sender] = (watts, total)
+                i = buf.find('\x02', i + STATUS_REPLY.size)
+                continue
+        elif kind == '\x50' and i + STANDARD_SIZE <= size:
+            i = buf.find('\x02', i + STANDARD_SIZE)
+            continue
+        elif kind == '\x62' and i + SENT_SIZE <= size:
+            to = binascii.hexlify(buf[i + 2:i + 5]).upper()
+            if to in wanted:
+                echoed.add(to)
+                readings.pop(to, None)
+            if ord(buf[i + 5]) & EXTENDED_FLAG:
+                i = buf.find('\x02', i + SENT_EXTENDED_SIZE)
+            else:
+                i = buf.find('\x02', i + SENT_SIZE)
+            continue
+        # not a message start after all, or cut off by the end of the buffer
+        i = buf.find('\x02', i + 1)
+    return readings
 
-def poll_smartlinc(address, device):
-    """Makes an HTTP request to a Smartlinc controller for a given device,
-    returns watts and accumulated watts
+def poll_smartlinc(address, devices):
+    """Makes HTTP requests to a Smartlinc controller for the given devices,
+    returns a dict of each device id (upper case) that answered to [watts,
+    accumulated watts]
     """
 
     # http:///i.js  iUpdateStatusB() for byte parsing, returns
@@ -70,71 +200,239 @@ def poll_smartlinc(address, device):
     # 00      Cmd2: (don't care value 0x00 - 0xFF)
     # =I=3    Trailer??
 
-    # send our command request
-    url = "http://" + address + "/3?0262" + device + "0F8200=I=3"
-    req = urlopen(url).read()
-    if req is None:
-        return
-    # fetch the buffer for the response
-    buffer = urlopen("http://" + address + "/buffstatus.xml").read()
+    # send our command requests
+    sent = 0
+    for device in devices:
+        # a command may have gone out before a connection failed, and
+        # mustn't be sent twice
+        status, _ = http.get(address, "/3?0262" + device + "0F8200=I=3",
+                             retry=False)
+        if status == 200:
+            sent += 1
+    if not sent:
+        return {}
+    # fetch the buffer for the responses
+    status, buffer = http.get(address, "/buffstatus.xml")
+    if status != 200:
+        return {}
 
-    if buffer == "<response><BS></BS></response>":
-        # response buffer empty
-        return
+    return parse_buffstatus(buffer, devices)
 
-    buffer = (buffer.replace("<response><BS>", "")
-              .replace("</BS></response>", ""))
+def poll_controller(addr, devices, deadline):
+    """Polls the devices behind one controller BATCH_SIZE at a time,
+    yielding (device, (watts, total), error) or (device, None, error) for a
+    failed poll, where error is True if the controller didn't answer.
+    Batches not started before the deadline are skipped.
+    """
 
-    # make sure the expected response is in the right spot
-    if buffer[41:44] == "251":
-        r_device = buffer[44:50]
-        r_cmd = buffer[58:60]
-        r_true = int(buffer[74:78], 16)
-        r_total = int(buffer[78:86], 16)
-        return [r_true, r_total]
+    for i in xrange(0, len(devices), BATCH_SIZE):
+        if time.time() >= deadline:
+            return
+        batch = devices[i:i + BATCH_SIZE]
+        try:
+            readings = poll_smartlinc(addr, batch)
+        except IOError, e:
+            print >> sys.stderr, ("error polling %s on %s: %s"
+                                  % (" ".join(batch), addr, e))
+            self_stats.error()
+            for deviceid in batch:
+                yield deviceid, None, True
+            continue
+        for deviceid in batch:
+            yield deviceid, readings.get(deviceid.upper()), False
 
-    return
+def poll_all(controllers, deadline):
+    """Polls every controller, up to MAX_CONCURRENCY of them at once.
+    Returns a list of (addr, device, watts, total) readings, the number
+    of dropped polls, which failed or weren't done by the deadline, and a
+    dict of each controller polled to the seconds it took, or None if it
+    failed or ran past the deadline. Workers still running at the deadline
+    are left to finish on their own and their late readings are discarded.
+    Controllers still busy from an earlier cycle are skipped this time
+    around.
+    """
 
-def main():
-    """smartlin_imeter main loop"""
-    drop_privileges()
+    work = Queue.Queue()
+    polled = []
+    with busy_lock:
+        for addr in controllers:
+            if addr not in busy:
+                busy.add(addr)
+                work.put(addr)
+                polled.append(addr)
 
-    interval = 15
+    state = {'readings': [], 'failed': 0, 'done': 0, 'closed': False,
+             'latency': {}}
+    lock = threading.Lock()
 
-    config_file = os.path.dirname(sys.argv[0]) + "/../etc/imeter.conf"
-    if not os.path.exists(config_file):
-        print >> sys.stderr, "config file %s not found" % config_file
-        sys.exit(13)
+    def worker():
+        while True:
+            try:
+                addr = work.get_nowait()
+            except Queue.Empty:
+                return
+            starttime = time.time()
+            answered = True
+            try:
+                for deviceid, data, error in poll_controller(
+                        addr, controllers[addr], deadline):
+                    with lock:
+                        if state['closed']:
+                            return
+                        state['done'] += 1
+                        if error:
+                            answered = False
+                        if data:
+                            watts, total = data
+                            state['readings'].append((addr, deviceid, watts,
+                                                      total))
+                        else:
+                            state['failed'] += 1
+                with lock:
+                    if answered and time.time() < deadline:
+                        state['latency'][addr] = time.time() - starttime
+            finally:
+                with busy_lock:
+                    busy.discard(addr)
+
+    threads = []
+    for _ in range(min(MAX_CONCURRENCY, work.qsize())):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join(max(0, deadline - time.time()))
+
+    with lock:
+        state['closed'] = True
+        total = sum(len(devices) for devices in controllers.values())
+        dropped = state['failed'] + (total - state['done'])
+        latency = dict((addr, state['latency'].get(addr)) for addr in polled)
+        return state['readings'], dropped, latency
+
+def read_config(path):
+    """Returns a dict of controller to device ids from the config file at
+    path, or None if it can't be read. Bad lines are reported and skipped.
+    """
+
+    try:
+        lines = open(path).readlines()
+    except IOError, e:
+        print >> sys.stderr, "can't read %s: %s" % (path, e)
+        return None
 
-    config = open(config_file)
-    for line in config:
-        if line.startswith('#'):
+    controllers = {}
+    for lineno, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
             continue
+        fields = line.split()
+        if len(fields) != 2 or not DEVICE_ID.match(fields[1]):
+            print >> sys.stderr, ("%s:%d: expected <controller> <device id>,"
+                                  " skipping %r" % (path, lineno, line))
+            continue
+        addr, deviceid = fields
+        devices = controllers.setdefault(addr, [])
+        if deviceid.upper() not in (device.upper() for device in devices):
+            devices.append(deviceid)
+    return controllers
 
-        [addr, deviceid] = line.split()
+def apply_config(controllers):
+    """Makes controllers the set of devices polled from now on. Controllers
+    that are gone lose their state, the others keep it.
+    """
 
-        try:
-            imeters[addr].append(deviceid)
-        except KeyError:
-            imeters[addr] = [deviceid]
-
-    while True:
-        ts = int(time.time())
-        # this should be parallellized to poll multiple smartlincs at once
-        # in case you have more devices than you can serially poll in an
-        # interval!
-        for addr in imeters:
-            for deviceid in imeters[addr]:
-                data = poll_smartlinc(addr, deviceid)
-                if data:
-                    [watts, total] = data
-                    print ("insteon.imeter.watt %s %d controller=%s device=%s"
-                           % (ts, watts, addr, deviceid))
-                    print ("insteon.imeter.total %s %d controller=%s device=%s"
-                           % (ts, total, addr, deviceid))
-
-        sys.stdout.flush()
-        time.sleep(interval)
+    for addr in set(imeters) - set(controllers):
+        print >> sys.stderr, "no longer polling controller %s" % addr
+        polls.pop(addr, None)
+    for addr, devices in controllers.iteritems():
+        added = set(devices) - set(imeters.get(addr, ()))
+        if added:
+            print >> sys.stderr, ("polling %s on controller %s"
+                                  % (" ".join(sorted(added)), addr))
+
+    # swapped wholesale, workers from an earlier cycle may still be
+    # iterating over the old lists
+    imeters.clear()
+    imeters.update(controllers)
+
+def setup():
+    """Reads the controllers and devices to poll from etc/imeter.conf and
+    starts watching it for changes
+    """
+
+    global config
+
+    if not os.path.exists(CONFIG_FILE):
+        print >> sys.stderr, "config file %s not found" % CONFIG_FILE
+        sys.exit(13)
+
+    config = configwatch.ConfigWatcher(CONFIG_FILE)
+    controllers = read_config(CONFIG_FILE)
+    if controllers is None:
+        sys.exit(1)
+    apply_config(controllers)
+
+def collect(out, ts):
+    """Polls the iMeters behind every controller that's due a poll"""
+
+    if config is not None and config.changed():
+        with self_stats.phase('config'):
+            controllers = read_config(CONFIG_FILE)
+        if controllers is None:
+            self_stats.error()
+        else:
+            apply_config(controllers)
+
+    due = {}
+    for addr, devices in imeters.iteritems():
+        if addr not in polls:
+            polls[addr] = scheduler.AdaptiveInterval(INTERVAL, POLL_MAX,
+                                                     POLL_BUDGET)
+        if polls[addr].due(ts):
+            due[addr] = devices
+    if not due:
+        return
+
+    starttime = time.time()
+
+    with self_stats.phase('poll'):
+        readings, dropped, latency = poll_all(due,
+                                              deadline=starttime + INTERVAL)
+    with self_stats.phase('emit'):
+        for addr, deviceid, watts, total in readings:
+            tags = {'controller': addr, 'device': deviceid}
+            out.emit('insteon.imeter.watt', ts, watts, tags, '%d')
+            out.emit('insteon.imeter.total', ts, total, tags, '%d')
+
+    out.emit('insteon.imeter.cycle_time_s', ts, time.time() - starttime,
+             fmt='%.3f')
+    out.emit('insteon.imeter.polls_dropped', ts, dropped, fmt='%d')
+    for addr, elapsed in latency.iteritems():
+        if elapsed is None:
+            polls[addr].failure()
+        else:
+            polls[addr].success(elapsed)
+        out.emit('insteon.imeter.poll_interval_s', ts, polls[addr].interval,
+                 {'controller': addr})
+    for addr, name, value in http.metrics():
+        out.emit('insteon.http.' + name, ts, value, {'controller': addr})
+
+def main():
+    """smartlin_imeter main loop"""
+    privileges.drop_privileges(USER)
+    setup()
+
+    out = emitter.Emitter(spool=SPOOL, rates=RATES, rate_state=RATE_STATE)
+    sched = scheduler.Scheduler(INTERVAL)
+    for ts in sched:
+        with self_stats.cycle():
+            collect(out, ts)
+        self_stats.report(out, ts, sched.missed)
+        with self_stats.phase('flush'):
+            out.flush()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,38 @@
+# Long-running wrapper around chef-server-stats.rb for chef-server.py
+#
+# Run with `knife exec` so Ruby, knife's config and the API client are only
+# loaded once. Every line read on stdin runs the stats script again, and its
+# JSON output is written back on stdout as a single line. Errors come back
+# as {"error": "..."} so the collector can log them and carry on.
+#
+# The stats script defaults to /root/chef-server-stats.rb, set
+# CHEF_STATS_SCRIPT in the environment to use another.
+
+require 'json'
+require 'stringio'
+
+stats_script = ENV['CHEF_STATS_SCRIPT'] || '/root/chef-server-stats.rb'
+stats_code = File.read(stats_script)
+real_stdout = $stdout
+real_stdout.sync = true
+
+while STDIN.gets
+  captured = StringIO.new
+  begin
+    $stdout = captured
+    # same context knife exec gave us, so nodes/search/etc. still work
+    instance_eval(stats_code, stats_script)
+  rescue StandardError => e
+    $stdout = real_stdout
+    puts({ 'error' => "#{e.class}: #{e.message}" }.to_json)
+    next
+  ensure
+    $stdout = real_stdout
+  end
+
+  begin
+    puts JSON.parse(captured.string).to_json
+  rescue JSON::ParserError => e
+    puts({ 'error' => "stats script output isn't JSON: #{e.message}" }.to_json)
+  end
+end
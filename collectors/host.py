@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Runs the collectors as plugins in one process
+
+Every collector in collectors/0 is normally its own Python process, with its
+own interpreter, imports and sleep loop. On a small box that's a lot of
+memory for reading a few sensors. This loads them all into one process
+instead, and runs each on its own thread:
+
+    PYTHONPATH=/path/to/repo python -m collectors.host [collector.py ...]
+
+With no arguments every collector in collectors/0 is loaded. Point
+tcollector at a directory holding just this (or run it on its own) rather
+than at collectors/0, or everything runs twice.
+
+A plugin is a collector module with:
+
+    INTERVAL          seconds between collections
+    setup()           optional, called once before collecting starts; may
+                      sys.exit(13) to say there's nothing for it to do here
+    collect(out, ts)  one collection, emitting into the Emitter out with
+                      timestamp ts, without flushing
+
+and optionally USER, DEDUP_HEARTBEAT, DEADBANDS, RATES and RATE_STATE,
+used the same way the collector uses them when it runs on its own. Each collector's main() is
+just that loop, so they all still run standalone too.
+
+Privileges are dropped once, to USER below, after every plugin's setup().
+Plugins that need root (their USER is 'root', or they don't say) are only
+run when USER here is 'root' too. A plugin whose setup() fails is left
+out, and one whose collect() raises is logged and tried again on its next
+tick, so one broken collector doesn't take the others down.
+
+Output goes through one stdout for everyone, so the plugins' own SPOOL
+settings are ignored in favour of SPOOL below. With TSD_ENDPOINTS set,
+points go straight to those TSDs instead, sharded by series and tagged
+with TSD_TAGS, and stdout isn't used; see collectors/lib/emitter.py.
+
+Each plugin's tcollector.self.* metrics (see collectors/lib/selfstats.py)
+are sent as usual, except for RSS and spool stats, which are the host's and
+go out every SELF_INTERVAL tagged collector=host.
+"""
+
+import glob
+import imp
+import os
+import sys
+import threading
+import traceback
+from collectors.lib import emitter
+from collectors.lib import privileges
+from collectors.lib import scheduler
+from collectors.lib import selfstats
+
+# User every plugin runs as
+USER = "nobody"
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "0")
+# Seconds between the host's own stats
+SELF_INTERVAL = 60
+# Spool file for output tcollector isn't reading yet, None blocks instead;
+# see collectors/lib/emitter.py
+SPOOL = None
+# "host:port" of TSDs to send to directly, rather than through tcollector
+TSD_ENDPOINTS = None
+# Tags added to every point sent to TSD_ENDPOINTS that doesn't have them,
+# as tcollector would. None is host=<this host>.
+TSD_TAGS = None
+
+
+class LockedSink(object):
+    """Lets several Emitters write to one sink without interleaving."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.sink.write(data)
+
+    def drain(self):
+        drain = getattr(self.sink, 'drain', None)
+        if drain is not None:
+            with self.lock:
+                drain()
+
+    def metrics(self):
+        metrics = getattr(self.sink, 'metrics', None)
+        if metrics is None:
+            return []
+        with self.lock:
+            return list(metrics())
+
+
+def load_plugin(path):
+    """Loads the collector at path, returns the module or None."""
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        module = imp.load_source(name, path)
+    except (Exception, SystemExit):
+        print >> sys.stderr, "can't load %s:" % path
+        traceback.print_exc()
+        return None
+
+    if not hasattr(module, 'collect') or not hasattr(module, 'INTERVAL'):
+        print >> sys.stderr, "%s isn't a plugin, skipping it" % path
+        return None
+    if getattr(module, 'USER', 'root') == 'root' and USER != 'root':
+        print >> sys.stderr, ("%s needs root, run it on its own or set USER"
+                              " to root" % path)
+        return None
+    return module
+
+
+def setup_plugin(module):
+    """Runs a plugin's setup(), returns False if it shouldn't be run."""
+
+    setup = getattr(module, 'setup', None)
+    if setup is None:
+        return True
+    try:
+        setup()
+    except SystemExit, e:
+        if e.code != 13:
+            print >> sys.stderr, ("%s setup exited with %s"
+                                  % (module.__name__, e.code))
+        return False
+    except Exception:
+        print >> sys.stderr, "%s setup failed:" % module.__name__
+        traceback.print_exc()
+        return False
+    return True
+
+
+def run_plugin(module, sink):
+    """Collects from one plugin on its interval, forever."""
+
+    out = emitter.Emitter(sink=sink,
+                          heartbeat=getattr(module, 'DEDUP_HEARTBEAT', 0),
+                          deadbands=getattr(module, 'DEADBANDS', None),
+                          rates=getattr(module, 'RATES', None),
+                          rate_state=getattr(module, 'RATE_STATE', None))
+    self_stats = getattr(module, 'self_stats', None)
+    if self_stats is None:
+        self_stats = selfstats.SelfStats(module.__name__)
+    sched = scheduler.Scheduler(module.INTERVAL)
+    for ts in sched:
+        try:
+            with self_stats.cycle():
+                module.collect(out, ts)
+        except Exception:
+            print >> sys.stderr, "%s collect failed:" % module.__name__
+            traceback.print_exc()
+            self_stats.error()
+        self_stats.report(out, ts, sched.missed, process=False)
+        with self_stats.phase('flush'):
+            out.flush()
+
+
+def main(argv):
+
+    paths = argv[1:] or sorted(glob.glob(os.path.join(PLUGIN_DIR, "*.py")))
+
+    plugins = []
+    for path in paths:
+        module = load_plugin(path)
+        if module is not None and setup_plugin(module):
+            plugins.append(module)
+    if not plugins:
+        print >> sys.stderr, "no plugins to run"
+        return 13
+
+    privileges.drop_privileges(USER)
+    sys.stdin.close()
+
+    if TSD_ENDPOINTS:
+        sink = emitter.TSDSink(TSD_ENDPOINTS, TSD_TAGS)
+    elif SPOOL:
+        sink = emitter.SpoolSink(sys.stdout.fileno(), SPOOL)
+    else:
+        sink = emitter.StreamSink(sys.stdout)
+    sink = LockedSink(sink)
+    threads = []
+    for module in plugins:
+        t = threading.Thread(target=run_plugin, args=(module, sink),
+                             name=module.__name__)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    print >> sys.stderr, ("running %s"
+                          % " ".join(module.__name__ for module in plugins))
+
+    out = emitter.Emitter(sink=sink)
+    self_stats = selfstats.SelfStats('host')
+    for ts in scheduler.Scheduler(SELF_INTERVAL):
+        self_stats.set('plugins_running', sum(t.is_alive() for t in threads))
+        self_stats.report(out, ts)
+        out.flush()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Noticing when a collector's config file changes
+
+A collector holds a ConfigWatcher on its config file and asks it once a
+cycle whether the file changed, rereading the file only when it did:
+
+    config = configwatch.ConfigWatcher(path)
+    for ts in scheduler.Scheduler(interval):
+        if config.changed():
+            ... reread path and apply it ...
+
+On Linux this is an inotify watch (through ctypes, there's no module for it
+in Python 2) on the file's directory, so a file replaced by an editor's
+save-and-rename is noticed as well as one written in place, and asking
+costs one non-blocking read. Writes are only noticed once the writer
+closes the file, so a half-written file isn't picked up. Where inotify
+isn't available, or the watch can't be set up, the file's mtime, size and
+inode are compared to the last look instead.
+
+changed() never blocks. A change is reported once, on the first call after
+it happened; several writes in one cycle are one change.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+# wd, mask, cookie, name length, followed by the name
+EVENT = struct.Struct('iIII')
+READ_SIZE = 4096
+
+
+def load_libc():
+    """Returns libc if it has inotify, otherwise None."""
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class ConfigWatcher(object):
+    """Tells whether the file at path changed since the last call."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(self.path)
+        self.fd = None
+        self.last = self.stat()
+        self.start_inotify()
+
+    def start_inotify(self):
+        libc = load_libc()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            print >> sys.stderr, ("inotify unavailable (%s), polling %s"
+                                  % (os.strerror(ctypes.get_errno()),
+                                     self.path))
+            return
+        wd = libc.inotify_add_watch(fd, os.path.dirname(self.path),
+                                    WATCH_MASK)
+        if wd < 0:
+            print >> sys.stderr, ("can't watch %s (%s), polling it"
+                                  % (self.path,
+                                     os.strerror(ctypes.get_errno())))
+            os.close(fd)
+            return
+        self.fd = fd
+
+    @property
+    def inotify(self):
+        return self.fd is not None
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def changed(self):
+        if self.fd is None:
+            current = self.stat()
+            if current == self.last:
+                return False
+            self.last = current
+            return True
+
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF |
+                           IN_IGNORED):
+                    # lost events, or the directory itself went away
+                    changed = True
+                    if not mask & IN_Q_OVERFLOW:
+                        self.close()
+                        break
+                elif name == self.name:
+                    changed = True
+            if self.fd is None:
+                break
+        if changed:
+            self.last = self.stat()
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Unit conversions and derived metrics over batches of sensor samples
+
+A collector lists what it derives from its raw readings, as (field,
+formula, input fields), and the valid range of any reading that can come
+back out of range:
+
+    pipeline = derived.Pipeline((
+        ('temp_f', derived.c_to_f, ('temp_c',)),
+        ('dew_point_c', derived.dew_point_c, ('temp_c', 'humid')),
+    ), limits={'humid': (0, 100)})
+
+and hands it a batch at a time, a dict of field to a column of samples,
+row aligned, so the nth value of every column comes from the same read:
+
+    batch = pipeline.apply({'temp_c': [21.3, 21.4], 'humid': [45.0, 130.0]})
+    for field, column in batch.iteritems():
+        values = derived.valid(column)
+        ...
+
+Each derived field is worked out for the whole batch in one map() over its
+input columns into an array('d'), in the order listed, so a formula can use
+fields derived before it. A formula missing an input gets skipped. Readings
+outside their limits become NaN, and so does anything derived from them,
+which valid() leaves out.
+"""
+
+import math
+from array import array
+
+NAN = float('nan')
+
+# Magnus formula coefficients for dew point over water, -45C to 60C
+MAGNUS_A = 17.62
+MAGNUS_B = 243.12
+# hPa per inch of mercury, as the collectors have always sent it
+HPA_PER_INHG = 33.87
+
+
+def c_to_f(temp_c):
+    return temp_c * 1.8 + 32
+
+
+def hpa_to_inhg(pressure_hpa):
+    return pressure_hpa / HPA_PER_INHG
+
+
+def supply_voltage(bus_v, shunt_mv):
+    """Volts on the supply side of an INA219's shunt."""
+
+    return bus_v + shunt_mv / 1000.0
+
+
+def power_w(bus_v, current_ma):
+    """Watts delivered to the load."""
+
+    return bus_v * current_ma / 1000.0
+
+
+def dew_point_c(temp_c, humid):
+    if not humid > 0:
+        return NAN
+    gamma = math.log(humid / 100.0) + MAGNUS_A * temp_c / (MAGNUS_B + temp_c)
+    return MAGNUS_B * gamma / (MAGNUS_A - gamma)
+
+
+def heat_index_c(temp_c, humid):
+    """The NWS heat index: Steadman's simple formula where that comes out
+    under 80F, the Rothfusz regression with its adjustments above.
+    """
+
+    t = c_to_f(temp_c)
+    index = 0.5 * (t + 61.0 + (t - 68.0) * 1.2 + humid * 0.094)
+    if (index + t) / 2 >= 80:
+        index = (-42.379 + 2.04901523 * t + 10.14333127 * humid
+                 - 0.22475541 * t * humid - 0.00683783 * t * t
+                 - 0.05481717 * humid * humid
+                 + 0.00122874 * t * t * humid
+                 + 0.00085282 * t * humid * humid
+                 - 0.00000199 * t * t * humid * humid)
+        if humid < 13 and 80 <= t <= 112:
+            index -= ((13 - humid) / 4 *
+                      math.sqrt((17 - abs(t - 95)) / 17))
+        elif humid > 85 and 80 <= t <= 87:
+            index += (humid - 85) / 10 * (87 - t) / 5
+    return (index - 32) / 1.8
+
+
+def valid(column):
+    """Returns the values of a column that aren't NaN."""
+
+    return [value for value in column if value == value]
+
+
+class Pipeline(object):
+    """Derives fields from batches of row-aligned sample columns."""
+
+    def __init__(self, derivations, limits=None):
+        self.derivations = derivations
+        self.limits = limits or {}
+
+    def apply(self, columns):
+        """Returns a dict of every column, raw and derived. columns isn't
+        changed.
+        """
+
+        batch = dict(columns)
+        for field, (low, high) in self.limits.iteritems():
+            if field in batch:
+                batch[field] = array('d', [value if low <= value <= high
+                                           else NAN
+                                           for value in batch[field]])
+        for field, formula, inputs in self.derivations:
+            try:
+                args = [batch[name] for name in inputs]
+            except KeyError:
+                continue
+            batch[field] = array('d', map(formula, *args))
+        return batch
@@ -0,0 +1,660 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Buffered emitter for the OpenTSDB line protocol
+
+Collects a whole cycle of data points and writes them out in one go, rather
+than formatting and printing every point on its own:
+
+    out = emitter.Emitter()
+    for ts in scheduler.Scheduler(interval):
+        out.emit('dht.temp_c', ts, temp_c, {'sensor': 'wall'}, '%.2f')
+        ...
+        out.flush()
+
+The "metric " head and " tag=value ..." tail of each series are rendered
+once and cached, so a point costs a couple of string concatenations. Hot
+loops can hold on to the Series handle from series() and call
+emit_series() to skip the cache lookup too.
+
+flush() joins the cycle into a single string and writes it with one write
+and flush of the stream (stdout by default). Given fd= instead, it's written
+straight to that file descriptor with os.write(), bypassing Python's file
+buffering, which is what you want when the fd is a pipe to tcollector.
+Several Emitters can also share one sink= object with a write(data)
+method, as the plugin host's collectors share its stdout.
+
+A write to the tcollector pipe blocks whenever tcollector (or the TSD
+behind it) falls behind, and a collector stuck in flush() isn't sampling.
+With spool=path, stdout (or fd) is made non-blocking instead, and whatever
+doesn't fit in the pipe is appended to a memory-mapped spool file of up to
+spool_size bytes. The spool is drained in order ahead of anything new on
+later flushes, and survives a restart. Batches that don't fit in the spool
+are dropped and counted:
+
+    out = emitter.Emitter(spool='/var/tmp/tcollector-ina219_power.spool')
+
+Rather than going through tcollector at all, an Emitter given tsd= (a list
+of "host:port" TSD endpoints) sends its points straight to them as put
+lines. Each series always goes to the same endpoint, picked by a hash of
+its metric and tags, over one kept-open connection per endpoint, and each
+flush is one batch per endpoint. An endpoint that fails is reconnected
+with exponential backoff, holding up to TSD_PENDING bytes for it meanwhile.
+As tcollector would, every line gets a host tag unless it has one already,
+or the tags in tsd_tags instead:
+
+    out = emitter.Emitter(tsd=['tsd1:4242', 'tsd2:4242'])
+
+Most of what gets collected is the same from one cycle to the next. With
+heartbeat=N, an Emitter only writes a point when its value changed since
+the last one it wrote for that series, or when N points in a row have been
+held back, so graphs still get a point every N intervals. For noisy float
+sensors, deadbands maps a metric name to how far its value may wander from
+the last one written before it counts as a change. deadbands need a
+heartbeat; without one every point is written, as a reading that stayed
+inside its deadband would otherwise never be written again:
+
+    out = emitter.Emitter(heartbeat=10, deadbands={'bme280.temp_c': 0.05})
+
+Counters are more useful to a dashboard as rates, and rate() over a long
+range is a costly TSD query. rates maps a counter metric to the metric its
+per-second rate is sent as, next to every raw point after the first one of
+a series; a (metric, seconds) pair gives the rate per that many seconds
+instead. A counter that went down was reset, by a reboot say, and gets no
+rate for that point. The last value and timestamp of each counter series
+are kept in a small memory-mapped hash table, in the file rate_state if
+given, so rates carry on across a restart of the collector:
+
+    out = emitter.Emitter(rates={'arris.down.corrected_errors':
+                                 'arris.down.corrected_errors_per_s'},
+                          rate_state='/var/tmp/tcollector-arris-modem.rates')
+"""
+
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from collections import deque
+
+# Cached series beyond this are dropped and rendered again on demand
+MAX_SERIES = 10000
+# Last values remembered for change-only emission, least recently used
+# series are forgotten first (and always sent the next time)
+MAX_DEDUP_SERIES = 10000
+# Default spool file size in bytes, about 10k points
+SPOOL_SIZE = 1024 * 1024
+# Most bytes written to the pipe per write while draining the spool
+DRAIN_CHUNK = 65536
+# Counter series remembered for rates, 24 bytes each in the state file
+RATE_SLOTS = 4096
+RATE_FORMAT = '%.6g'
+# Seconds to wait on a TSD while connecting or sending
+TSD_TIMEOUT = 10
+# Seconds before reconnecting to a TSD that failed, doubling while it keeps
+# failing up to TSD_BACKOFF_MAX
+TSD_BACKOFF_MIN = 1
+TSD_BACKOFF_MAX = 60
+# Most bytes held for a TSD that's down, the oldest batches go beyond that
+TSD_PENDING = 1024 * 1024
+TSD_PORT = 4242
+
+
+class Series(object):
+    """A metric and tag set with its rendered line head and tail."""
+
+    __slots__ = ('metric', 'tags', 'fmt', 'head', 'tail')
+
+    # tail ends in the newline, a line is head + ts + " " + value + tail
+
+    def __init__(self, metric, tags, fmt):
+        self.metric = metric
+        self.tags = tags
+        self.fmt = fmt
+        self.head = metric + ' '
+        if tags:
+            self.tail = ' ' + ' '.join('%s=%s' % (k, v)
+                                       for k, v in sorted(tags.iteritems()))
+        else:
+            self.tail = ''
+        self.tail += '\n'
+
+    def line(self, ts, value):
+        return self.head + str(ts) + ' ' + self.fmt % value + self.tail
+
+
+class Deduplicator(object):
+    """Decides which points to drop because their value hasn't changed."""
+
+    def __init__(self, heartbeat, deadbands=None, max_series=None):
+        self.heartbeat = heartbeat
+        self.deadbands = deadbands or {}
+        self.max_series = max_series or MAX_DEDUP_SERIES
+        # head + tail -> [last value sent, points held back since]
+        self.last = OrderedDict()
+        self.suppressed = 0
+
+    def keep(self, series, value, rendered):
+        """Returns True if the point should be written. rendered is the
+        value as it will be written, which is what's compared unless the
+        metric has a deadband.
+        """
+
+        key = series.head + series.tail
+        state = self.last.pop(key, None)
+        if state is not None and state[1] + 1 < self.heartbeat:
+            band = self.deadbands.get(series.metric)
+            if band is None:
+                unchanged = rendered == state[0]
+            else:
+                unchanged = abs(value - state[0]) <= band
+            if unchanged:
+                state[1] += 1
+                self.last[key] = state
+                self.suppressed += 1
+                return False
+
+        if series.metric in self.deadbands:
+            self.last[key] = [value, 0]
+        else:
+            self.last[key] = [rendered, 0]
+        if len(self.last) > self.max_series:
+            self.last.popitem(last=False)
+        return True
+
+
+class StreamSink(object):
+    """Writes to a file object, flushing after every batch."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        self.stream.write(data)
+        self.stream.flush()
+
+
+class FdSink(object):
+    """Writes bytes straight to a file descriptor."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+
+def map_state_file(path, size):
+    """Maps size bytes of the file at path, creating it if need be. Returns
+    (map, fresh), fresh meaning the file was new or the wrong size.
+
+    These files sit in shared directories like /var/tmp, and some
+    collectors run as root, so a symlink, or anything else that isn't a
+    regular file of ours with a single link, raises OSError rather than
+    being opened through.
+    """
+
+    fd = os.open(path, (os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW |
+                        os.O_NOCTTY | os.O_NONBLOCK), 0600)
+    try:
+        st = os.fstat(fd)
+        if (not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or
+                st.st_nlink != 1):
+            raise OSError(errno.EPERM, "not a regular file of ours, won't "
+                          "use it", path)
+        fresh = st.st_size != size
+        if fresh:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size), fresh
+    finally:
+        os.close(fd)
+
+
+class Spool(object):
+    """A byte queue in a memory-mapped file of a fixed size.
+
+    Data is appended at the tail and consumed from the head; the offsets are
+    kept in a header at the start of the file so a restarted collector picks
+    up where it left off. When an append won't fit after the tail, what's
+    left is moved back to the start of the file first.
+    """
+
+    HEADER = struct.Struct('<QQ')
+
+    def __init__(self, path, size):
+        self.size = size
+        self.base = self.HEADER.size
+        self.map, fresh = map_state_file(path, self.base + size)
+
+        self.head, self.tail = self.HEADER.unpack_from(self.map, 0)
+        if fresh or not self.head <= self.tail <= size:
+            self.head = self.tail = 0
+            self.save()
+        self.points = self.map[self.base + self.head:
+                               self.base + self.tail].count('\n')
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def save(self):
+        self.HEADER.pack_into(self.map, 0, self.head, self.tail)
+
+    def append(self, data):
+        """Appends data, returns False if it doesn't fit."""
+
+        if len(data) > self.size - len(self):
+            return False
+        if self.tail + len(data) > self.size:
+            self.map.move(self.base, self.base + self.head, len(self))
+            self.tail -= self.head
+            self.head = 0
+        start = self.base + self.tail
+        self.map[start:start + len(data)] = data
+        self.tail += len(data)
+        self.points += data.count('\n')
+        self.save()
+        return True
+
+    def peek(self, n):
+        """Returns up to n bytes from the head without consuming them."""
+
+        return self.map[self.base + self.head:
+                        self.base + min(self.tail, self.head + n)]
+
+    def consume(self, data):
+        """Drops data, which peek() returned, from the head."""
+
+        self.head += len(data)
+        self.points -= data.count('\n')
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        self.save()
+
+
+class SpoolSink(object):
+    """Writes to a non-blocking fd, spooling what the fd won't take."""
+
+    def __init__(self, fd, path, size=None):
+        self.fd = fd
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.spool = Spool(path, size or SPOOL_SIZE)
+        self.dropped = 0
+
+    def send(self, data):
+        """Writes what the fd will take right now, returns how much."""
+
+        try:
+            return os.write(self.fd, data)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def drop(self, data):
+        self.dropped += data.count('\n')
+
+    def write(self, data):
+        if len(self.spool):
+            # older points go first
+            if not self.spool.append(data):
+                self.drop(data)
+            self.drain()
+            return
+
+        rest = data[self.send(data):]
+        if rest and not self.spool.append(rest):
+            # finish the line that was cut off, drop the lines after it
+            cut = rest.find('\n') + 1
+            if self.spool.append(rest[:cut]):
+                rest = rest[cut:]
+            self.drop(rest)
+
+    def drain(self):
+        """Writes out as much of the spool as the fd will take."""
+
+        while len(self.spool):
+            chunk = self.spool.peek(DRAIN_CHUNK)
+            written = self.send(chunk)
+            if not written:
+                return
+            self.spool.consume(chunk[:written])
+
+    def metrics(self):
+        """Yields (name, value) for the spool depth and drops."""
+
+        yield 'spool_bytes', len(self.spool)
+        yield 'spool_points', self.spool.points
+        yield 'spool_dropped', self.dropped
+
+
+class TSDConnection(object):
+    """A kept-open connection to one TSD, and the put lines waiting to go
+    out on it.
+    """
+
+    def __init__(self, endpoint):
+        host, _, port = endpoint.partition(':')
+        self.endpoint = endpoint
+        self.address = (host, int(port or TSD_PORT))
+        self.sock = None
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.backoff = TSD_BACKOFF_MIN
+        self.next_attempt = 0
+        self.connects = 0
+        self.dropped = 0
+
+    def queue(self, data):
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        while self.pending_bytes > TSD_PENDING:
+            old = self.pending.popleft()
+            self.pending_bytes -= len(old)
+            self.dropped += old.count('\n')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def fail(self, error):
+        print >> sys.stderr, ("tsd %s failed: %s, retrying in %ds"
+                              % (self.endpoint, error, self.backoff))
+        self.close()
+        self.next_attempt = time.time() + self.backoff
+        self.backoff = min(self.backoff * 2, TSD_BACKOFF_MAX)
+
+    def read_errors(self):
+        """Reads whatever the TSD said back, which is only ever complaints
+        about bad put lines. Returns False if it hung up.
+        """
+
+        # recv() on a socket with a timeout waits for data, even with
+        # MSG_DONTWAIT, so look first
+        while select.select([self.sock], [], [], 0)[0]:
+            reply = self.sock.recv(4096)
+            if not reply:
+                return False
+            print >> sys.stderr, ("tsd %s: %s"
+                                  % (self.endpoint, reply.strip()))
+        return True
+
+    def send(self):
+        """Sends everything pending, if the TSD is up or due a retry."""
+
+        if not self.pending:
+            return
+        if self.sock is None:
+            if time.time() < self.next_attempt:
+                return
+            try:
+                self.sock = socket.create_connection(self.address,
+                                                     TSD_TIMEOUT)
+            except socket.error, e:
+                self.fail(e)
+                return
+            self.connects += 1
+
+        try:
+            if not self.read_errors():
+                self.fail("connection closed")
+                return
+            self.sock.sendall(''.join(self.pending))
+        except socket.error, e:
+            # the whole batch goes again, a TSD keeps one of duplicate
+            # points
+            self.fail(e)
+            return
+        self.pending.clear()
+        self.pending_bytes = 0
+        self.backoff = TSD_BACKOFF_MIN
+
+
+class TSDSink(object):
+    """Sends lines as TSD put commands, sharded by series over endpoints.
+    tags are added to every line that doesn't have them, host=<this host>
+    by default.
+    """
+
+    def __init__(self, endpoints, tags=None):
+        self.connections = [TSDConnection(endpoint)
+                            for endpoint in endpoints]
+        if tags is None:
+            tags = {'host': socket.gethostname()}
+        # (" name=", " name=value") for each tag
+        self.tags = [(' %s=' % k, ' %s=%s' % (k, v))
+                     for k, v in sorted(tags.iteritems())]
+
+    def write(self, data):
+        shards = len(self.connections)
+        batches = [[] for _ in self.connections]
+        for line in data.splitlines():
+            for name, tag in self.tags:
+                if name not in line:
+                    line += tag
+            line += '\n'
+            if shards == 1:
+                shard = 0
+            else:
+                # metric ts value[ tags], the series is all but ts and value
+                fields = line.split(' ', 3)
+                if len(fields) > 3:
+                    key = fields[0] + ' ' + fields[3]
+                else:
+                    key = fields[0]
+                shard = (zlib.crc32(key) & 0xffffffff) % shards
+            batches[shard].append('put ' + line)
+
+        for connection, batch in zip(self.connections, batches):
+            if batch:
+                connection.queue(''.join(batch))
+            connection.send()
+
+    def drain(self):
+        for connection in self.connections:
+            connection.send()
+
+    def metrics(self):
+        """Yields (name, value) for the lines held and dropped, connections
+        open and connects made.
+        """
+
+        connections = self.connections
+        yield 'tsd_pending_bytes', sum(c.pending_bytes for c in connections)
+        yield 'tsd_dropped', sum(c.dropped for c in connections)
+        yield 'tsd_connected', sum(c.sock is not None for c in connections)
+        yield 'tsd_connects', sum(c.connects for c in connections)
+
+
+class Rates(object):
+    """Turns counter points into rates.
+
+    The last (timestamp, value) of each counter series lives in a slot of
+    an open addressing hash table in a memory-mapped file (or anonymous
+    memory without a path), keyed by a 64 bit hash of the series' line head
+    and tail. Each series' slot is looked up once and remembered. When the
+    table fills up it's cleared, which costs every counter one rate point.
+    """
+
+    HEADER = struct.Struct('<4sI')
+    SLOT = struct.Struct('<Qqd')
+    MAGIC = 'RAT1'
+
+    def __init__(self, rates, path=None, slots=None):
+        # counter metric -> (rate metric, seconds per rate)
+        self.rates = {}
+        for metric, rate in rates.iteritems():
+            if isinstance(rate, basestring):
+                rate = (rate, 1)
+            self.rates[metric] = rate
+        self.slots = slots or RATE_SLOTS
+        size = self.HEADER.size + self.slots * self.SLOT.size
+        self.map = None
+        if path is not None:
+            try:
+                self.map, fresh = map_state_file(path, size)
+            except OSError, e:
+                print >> sys.stderr, ("can't keep rates in %s, they'll start"
+                                      " over on restart: %s" % (path, e))
+        if self.map is None:
+            self.map = mmap.mmap(-1, size)
+            fresh = True
+        if fresh or self.HEADER.unpack_from(self.map, 0) != (self.MAGIC,
+                                                              self.slots):
+            self.clear()
+        # line head + tail -> slot offset
+        self.offsets = {}
+        self.resets = 0
+
+    def clear(self):
+        self.map[:] = '\0' * len(self.map)
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.slots)
+        self.offsets = {}
+
+    def offset(self, key):
+        """Returns the offset of key's slot, claiming a free one for a new
+        key, or None if the table is full.
+        """
+
+        try:
+            return self.offsets[key]
+        except KeyError:
+            pass
+        khash = struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] or 1
+        start = khash % self.slots
+        for i in xrange(self.slots):
+            offset = (self.HEADER.size +
+                      (start + i) % self.slots * self.SLOT.size)
+            slot = self.SLOT.unpack_from(self.map, offset)[0]
+            if slot == khash or slot == 0:
+                if slot == 0:
+                    self.SLOT.pack_into(self.map, offset, khash, 0, 0)
+                self.offsets[key] = offset
+                return offset
+        return None
+
+    def derive(self, series, ts, value):
+        """Records a counter point, returns its rate or None when there's
+        none to send.
+        """
+
+        key = series.head + series.tail
+        offset = self.offset(key)
+        if offset is None:
+            print >> sys.stderr, ("more than %d counter series, starting"
+                                  " rates over" % self.slots)
+            self.clear()
+            offset = self.offset(key)
+        khash, last_ts, last = self.SLOT.unpack_from(self.map, offset)
+        if ts <= last_ts:
+            return None
+        self.SLOT.pack_into(self.map, offset, khash, ts, value)
+        if not last_ts:
+            return None
+        if value < last:
+            self.resets += 1
+            return None
+        return (value - last) * self.rates[series.metric][1] / float(
+            ts - last_ts)
+
+
+class Emitter(object):
+    """Buffers data points for a cycle and writes them with flush()."""
+
+    def __init__(self, stream=None, fd=None, heartbeat=0, deadbands=None,
+                 sink=None, spool=None, spool_size=None, rates=None,
+                 rate_state=None, tsd=None, tsd_tags=None):
+        if rates:
+            self.rates = Rates(rates, rate_state)
+        else:
+            self.rates = None
+        if heartbeat:
+            self.dedup = Deduplicator(heartbeat, deadbands)
+        else:
+            self.dedup = None
+        if sink is not None:
+            self.sink = sink
+        elif tsd:
+            self.sink = TSDSink(tsd, tsd_tags)
+        elif spool is not None:
+            if fd is None:
+                fd = (stream or sys.stdout).fileno()
+            self.sink = SpoolSink(fd, spool, spool_size)
+        elif fd is not None:
+            self.sink = FdSink(fd)
+        else:
+            self.sink = StreamSink(stream or sys.stdout)
+        self.cache = {}
+        self.buffer = []
+
+    def series(self, metric, tags=None, fmt='%s'):
+        """Returns the cached Series for metric, tags and value format."""
+
+        # Not sorted: equal dicts with a different item order just get
+        # cached twice, and the rendered tail is sorted either way.
+        if tags:
+            key = (metric, fmt) + tuple(tags.iteritems())
+        else:
+            key = (metric, fmt)
+        try:
+            return self.cache[key]
+        except KeyError:
+            if len(self.cache) >= MAX_SERIES:
+                self.cache.clear()
+            series = self.cache[key] = Series(metric, tags, fmt)
+            return series
+
+    def emit(self, metric, ts, value, tags=None, fmt='%s'):
+        """Buffers one data point. value is rendered with fmt."""
+
+        if tags:
+            key = (metric, fmt) + tuple(tags.iteritems())
+        else:
+            key = (metric, fmt)
+        series = self.cache.get(key)
+        if series is None:
+            series = self.series(metric, tags, fmt)
+        rendered = fmt % value
+        if self.dedup is None or self.dedup.keep(series, value, rendered):
+            self.buffer.append(series.head + str(ts) + ' ' + rendered +
+                               series.tail)
+        if self.rates is not None and metric in self.rates.rates:
+            self.emit_rate(series, ts, value)
+
+    def emit_series(self, series, ts, value):
+        rendered = series.fmt % value
+        if self.dedup is None or self.dedup.keep(series, value, rendered):
+            self.buffer.append(series.head + str(ts) + ' ' + rendered +
+                               series.tail)
+        if self.rates is not None and series.metric in self.rates.rates:
+            self.emit_rate(series, ts, value)
+
+    def emit_rate(self, series, ts, value):
+        rate = self.rates.derive(series, ts, value)
+        if rate is not None:
+            self.emit(self.rates.rates[series.metric][0], ts, rate,
+                      series.tags, RATE_FORMAT)
+
+    def flush(self):
+        """Writes out everything buffered since the last flush."""
+
+        if not self.buffer:
+            drain = getattr(self.sink, 'drain', None)
+            if drain is not None:
+                drain()
+            return
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.sink.write(data)
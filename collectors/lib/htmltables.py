@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Streaming extractor for HTML tables
+
+Pulls the rows out of just the tables we care about without building a
+document tree. Tables are picked by a keyword in one of their <th> cells,
+the way the modem status pages title each table:
+
+    tables = htmltables.TableExtractor({'downstream': 'Downstream',
+                                        'upstream': 'Upstream'})
+    tables.feed(chunk)      # as many times as there are chunks
+    tables.close()
+    for cols in tables.rows['downstream']:
+        ...
+
+Each row is a list of the stripped text of its <td> cells, so header rows
+made only of <th> come out as empty lists. Rows of a nested table belong to
+the innermost table only. Text is only kept while inside a table cell.
+"""
+
+import HTMLParser
+from htmlentitydefs import name2codepoint
+
+
+class Table(object):
+    """Parse state for one open <table>."""
+
+    def __init__(self):
+        self.headers = []
+        self.rows = []
+        self.row = None
+        self.cell = None
+        self.in_th = False
+
+    def end_cell(self):
+        if self.cell is None:
+            return
+        text = ''.join(self.cell).strip()
+        if self.in_th:
+            self.headers.append(text)
+        elif self.row is not None:
+            self.row.append(text)
+        self.cell = None
+        self.in_th = False
+
+
+class TableExtractor(HTMLParser.HTMLParser):
+    """Collects <td> rows of tables whose <th> text contains a keyword."""
+
+    def __init__(self, wanted):
+        HTMLParser.HTMLParser.__init__(self)
+        self.wanted = wanted
+        self.rows = dict((name, []) for name in wanted)
+        self.tables = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self.tables.append(Table())
+            return
+        if not self.tables:
+            return
+        table = self.tables[-1]
+        if tag == 'tr':
+            table.end_cell()
+            table.row = []
+            table.rows.append(table.row)
+        elif tag in ('td', 'th'):
+            table.end_cell()
+            table.cell = []
+            table.in_th = tag == 'th'
+        elif tag == 'br' and table.cell is not None:
+            table.cell.append(' ')
+
+    def handle_endtag(self, tag):
+        if not self.tables:
+            return
+        table = self.tables[-1]
+        if tag in ('td', 'th'):
+            table.end_cell()
+        elif tag == 'tr':
+            table.end_cell()
+            table.row = None
+        elif tag == 'table':
+            table.end_cell()
+            self.tables.pop()
+            headers = ' '.join(table.headers)
+            for name, keyword in self.wanted.iteritems():
+                if keyword in headers:
+                    self.rows[name].extend(table.rows)
+
+    def append(self, text):
+        if self.tables and self.tables[-1].cell is not None:
+            self.tables[-1].cell.append(text)
+
+    def handle_data(self, data):
+        self.append(data)
+
+    def handle_entityref(self, name):
+        if name == 'nbsp':
+            self.append(' ')
+        elif name in name2codepoint:
+            self.append(unichr(name2codepoint[name]).encode('utf-8'))
+
+    def handle_charref(self, name):
+        try:
+            if name.lower().startswith('x'):
+                code = int(name[1:], 16)
+            else:
+                code = int(name)
+        except ValueError:
+            return
+        self.append(unichr(code).encode('utf-8'))
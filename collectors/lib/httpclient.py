@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Keep-alive HTTP client shared by the collectors
+
+The SmartLinc controllers and the Arris modem run slow embedded web servers
+where setting up and tearing down a TCP connection is a big part of every
+request. HTTPClient keeps a small pool of idle HTTP/1.1 connections per host
+and reuses them across polls.
+
+    http = httpclient.HTTPClient(pool_size=1, idle_timeout=60)
+    status, body = http.get("192.168.100.1", "/RgConnect.asp", timeout=30)
+
+Connections that have sat idle longer than idle_timeout are closed rather
+than reused. A reused connection the server has quietly dropped is retried
+once on a fresh connection, but only when nothing of the response had come
+back yet and the request didn't time out; pass retry=False for requests
+that mustn't be sent twice at all. Failures, including a body cut short,
+raise HTTPClientError, which is an IOError like the urllib errors it
+replaces.
+
+Per-host counters are available from metrics(), for collectors to emit as
+<prefix>.http.* with a host tag:
+    requests             Requests made (counter)
+    errors               Requests that failed (counter)
+    connections_opened   New TCP connections (counter)
+    connections_reused   Requests served on a kept-alive connection (counter)
+    latency_s            Mean request latency since the last metrics() call
+    latency_max_s        Worst request latency since the last metrics() call
+"""
+
+import httplib
+import socket
+import threading
+import time
+
+# Bytes read at a time when streaming a response body
+CHUNK_SIZE = 8192
+
+
+class HTTPClientError(IOError):
+    """A request failed before a complete response was read."""
+
+
+class HostStats(object):
+    """Request counters for one host."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.opened = 0
+        self.reused = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_count = 0
+
+
+class HostPool(object):
+    """Idle connections to a single host, at most pool_size in use."""
+
+    def __init__(self, host, pool_size, idle_timeout):
+        self.host = host
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.stats = HostStats()
+
+    def checkout(self, timeout):
+        """Returns (conn, reused). Caller must already hold a slot."""
+
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                conn, last_used = self.idle.pop()
+                if now - last_used < self.idle_timeout:
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return httplib.HTTPConnection(self.host, timeout=timeout), False
+
+    def checkin(self, conn):
+        with self.lock:
+            self.idle.append((conn, time.time()))
+
+    def close(self):
+        with self.lock:
+            for conn, _ in self.idle:
+                conn.close()
+            self.idle = []
+
+
+class HTTPClient(object):
+    """Keep-alive HTTP client with a connection pool per host."""
+
+    def __init__(self, pool_size=2, idle_timeout=30, timeout=30):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def pool(self, host):
+        with self.lock:
+            try:
+                return self.pools[host]
+            except KeyError:
+                pool = HostPool(host, self.pool_size, self.idle_timeout)
+                self.pools[host] = pool
+                return pool
+
+    def get(self, host, path, timeout=None, headers=None, stream=None,
+            retry=True):
+        """Fetches http://host/path, returns (status, body). If stream is
+        given, it's called with each chunk of the body as it arrives
+        instead, and body is returned as None. retry=False never sends the
+        request a second time.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+        pool = self.pool(host)
+        stats = pool.stats
+
+        pool.slots.acquire()
+        try:
+            starttime = time.time()
+            conn, reused = pool.checkout(timeout)
+            try:
+                while True:
+                    try:
+                        response = self._send(conn, path, headers)
+                        break
+                    except (httplib.HTTPException, socket.error), e:
+                        conn.close()
+                        # Only a dropped idle connection is worth another
+                        # go: nothing came back, and it wasn't a timeout.
+                        if (not reused or not retry or
+                                isinstance(e, socket.timeout)):
+                            raise
+                        conn = httplib.HTTPConnection(host, timeout=timeout)
+                        reused = False
+                status, body, will_close = self._read(response, stream)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                with pool.lock:
+                    stats.requests += 1
+                    if reused:
+                        stats.reused += 1
+                    else:
+                        stats.opened += 1
+                    stats.errors += 1
+                raise HTTPClientError("GET http://%s%s: %s"
+                                      % (host, path, e))
+
+            if will_close:
+                conn.close()
+            else:
+                pool.checkin(conn)
+
+            latency = time.time() - starttime
+            with pool.lock:
+                stats.requests += 1
+                if reused:
+                    stats.reused += 1
+                else:
+                    stats.opened += 1
+                stats.latency_total += latency
+                stats.latency_count += 1
+                stats.latency_max = max(stats.latency_max, latency)
+            return status, body
+        finally:
+            pool.slots.release()
+
+    def _send(self, conn, path, headers):
+        """Sends the request and reads the status line and headers."""
+
+        conn.request("GET", path, headers=headers or {})
+        return conn.getresponse()
+
+    def _read(self, response, stream):
+        if stream is None:
+            return response.status, response.read(), response.will_close
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            stream(chunk)
+        # read(amt) just stops short when the server closes early
+        if response.length:
+            raise httplib.IncompleteRead('', response.length)
+        return response.status, None, response.will_close
+
+    def metrics(self):
+        """Yields (host, name, value) for every host's counters, and resets
+        the latency figures for the next call.
+        """
+
+        with self.lock:
+            pools = self.pools.items()
+        for host, pool in pools:
+            with pool.lock:
+                stats = pool.stats
+                values = [
+                    ('requests', stats.requests),
+                    ('errors', stats.errors),
+                    ('connections_opened', stats.opened),
+                    ('connections_reused', stats.reused),
+                ]
+                if stats.latency_count:
+                    values.append(('latency_s', stats.latency_total /
+                                   stats.latency_count))
+                    values.append(('latency_max_s', stats.latency_max))
+                stats.latency_total = 0.0
+                stats.latency_max = 0.0
+                stats.latency_count = 0
+            for name, value in values:
+                yield host, name, value
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Dropping root for the collectors
+
+Collectors that don't need root switch to an unprivileged user (USER in
+each collector, "nobody" by default) before they start collecting. The
+plugin host does this once for every collector it runs.
+"""
+
+import os
+import pwd
+
+
+def drop_privileges(user="nobody"):
+    """Switches to user if we're running as root and that user exists.
+    'root' keeps root.
+    """
+
+    if user == 'root':
+        return
+
+    try:
+        ent = pwd.getpwnam(user)
+    except KeyError:
+        return
+
+    if os.getuid() != 0:
+        return
+    os.setgid(ent.pw_gid)
+    os.setuid(ent.pw_uid)
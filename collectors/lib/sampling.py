@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""High-rate sensor sampling with aggregation at emit time
+
+Reading a sensor once per interval throws away everything that happens in
+between. Sampler reads it in a background thread at a fixed rate into ring
+buffers, and the collector drains them once per interval and sends
+aggregates instead of every sample:
+
+    sampler = sampling.Sampler(read, ('temp_c', 'humid'), rate=1.0,
+                               size=64)
+    sampler.start()
+    for ts in scheduler.Scheduler(interval):
+        for field, values in sampler.drain().iteritems():
+            stats = sampling.aggregate(values)
+            ...
+
+read() returns a dict of field to value; fields it leaves out (or sets to
+None) are skipped for that sample. When read() raises, the sampler backs
+off exponentially from BACKOFF_MIN up to BACKOFF_MAX seconds before trying
+again, and counts the failure in .errors.
+
+Each ring buffer is an array('d') of fixed size. If a collector falls behind
+by more than size samples, the oldest ones are overwritten.
+"""
+
+import math
+import sys
+import threading
+import time
+from array import array
+
+# Seconds to wait after a failed read, doubling up to BACKOFF_MAX
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30
+
+AGGREGATES = ('mean', 'min', 'max', 'stddev', 'p95')
+
+
+class RingBuffer(object):
+    """Fixed-size ring of floats, not thread-safe on its own."""
+
+    def __init__(self, size):
+        self.data = array('d', [0.0]) * size
+        self.size = size
+        self.next = 0
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.next] = value
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def drain(self):
+        """Returns the buffered values oldest first, and empties it."""
+
+        start = (self.next - self.count) % self.size
+        if start + self.count <= self.size:
+            values = self.data[start:start + self.count]
+        else:
+            values = self.data[start:] + self.data[:self.next]
+        self.count = 0
+        return values
+
+
+def aggregate(values):
+    """Returns a dict of AGGREGATES over a non-empty sequence of floats.
+    Sorts once, which gives min, max and p95, and makes a single pass for
+    the sum and sum of squares.
+    """
+
+    ordered = sorted(values)
+    n = len(ordered)
+    total = 0.0
+    squares = 0.0
+    for value in ordered:
+        total += value
+        squares += value * value
+    mean = total / n
+    variance = max(0.0, squares / n - mean * mean)
+    return {
+        'mean': mean,
+        'min': ordered[0],
+        'max': ordered[-1],
+        'stddev': math.sqrt(variance),
+        'p95': ordered[min(n - 1, int(math.ceil(0.95 * n)) - 1)],
+    }
+
+
+class Sampler(threading.Thread):
+    """Reads a sensor rate times a second into a ring buffer per field."""
+
+    def __init__(self, read, fields, rate, size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.read = read
+        self.period = 1.0 / rate
+        self.buffers = dict((field, RingBuffer(size)) for field in fields)
+        self.lock = threading.Lock()
+        self.errors = 0
+
+    def run(self):
+        backoff = BACKOFF_MIN
+        next_read = time.time()
+        while True:
+            try:
+                sample = self.read()
+            except Exception, e:
+                self.errors += 1
+                print >> sys.stderr, ("sensor read failed, retrying in "
+                                      "%.1fs: %s" % (backoff, e))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+                next_read = time.time()
+                continue
+            backoff = BACKOFF_MIN
+
+            with self.lock:
+                for field, value in sample.iteritems():
+                    if value is not None and field in self.buffers:
+                        self.buffers[field].append(value)
+
+            next_read += self.period
+            delay = next_read - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # fell behind, don't try to catch up in a burst
+                next_read = time.time()
+
+    def drain(self):
+        """Returns a dict of field to the values sampled since the last
+        drain, leaving out fields with no samples.
+        """
+
+        with self.lock:
+            drained = {}
+            for field, buf in self.buffers.iteritems():
+                if buf.count:
+                    drained[field] = buf.drain()
+            return drained
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Drift-free interval scheduler for the collectors
+
+Sleeping a fixed interval after each collection makes the real period the
+interval plus however long the work took, and nothing lines up between
+collectors. Scheduler instead fires on wall-clock ticks that are multiples
+of the interval, and hands back the tick as the timestamp to report:
+
+    for ts in scheduler.Scheduler(interval):
+        ... collect and print with ts ...
+
+If a collection overruns past the next tick, the ticks it ran over are
+skipped rather than fired back to back, and counted in .missed.
+
+To keep every collector on a box from waking at the same instant, each
+Scheduler picks a random offset of up to jitter seconds when it's created,
+and wakes that long after each tick. Timestamps are still the aligned ticks.
+
+Devices that are slow to answer get an AdaptiveInterval on top: the
+collector still ticks on its Scheduler, but only polls a device on the ticks
+its AdaptiveInterval says are due. The poll period stretches to keep the
+device busy answering no more than budget of the time, going by its mean
+response time over the last window polls, and doubles with every failed
+poll in a row until one succeeds:
+
+    poll = scheduler.AdaptiveInterval(interval, maximum=600)
+    for ts in scheduler.Scheduler(interval):
+        if not poll.due(ts):
+            continue
+        try:
+            ... poll, timing it ...
+        except IOError:
+            poll.failure()
+        else:
+            poll.success(elapsed)
+"""
+
+import collections
+import math
+import random
+import time
+
+# Default upper bound, in seconds, for the random offset after each tick
+JITTER = 2
+# Default share of the time an adaptively polled device should spend
+# answering us, and how many response times to average over
+BUDGET = 0.25
+WINDOW = 10
+
+
+class Scheduler(object):
+    """Iterates over aligned tick timestamps, sleeping until each one."""
+
+    def __init__(self, interval, jitter=None):
+        if jitter is None:
+            jitter = JITTER
+        self.interval = interval
+        self.offset = random.uniform(0, min(jitter, interval / 2.0))
+        self.missed = 0
+        self.next_tick = None
+
+    def __iter__(self):
+        while True:
+            yield self.wait()
+
+    def wait(self):
+        """Sleeps until the next tick is due, returns its timestamp."""
+
+        now = time.time()
+        if self.next_tick is None:
+            tick = (int(now // self.interval) + 1) * self.interval
+        else:
+            tick = self.next_tick
+            if tick + self.offset < now:
+                late = int((now - self.offset - tick) // self.interval) + 1
+                self.missed += late
+                tick += late * self.interval
+
+        delay = tick + self.offset - now
+        if delay > 0:
+            time.sleep(delay)
+        self.next_tick = tick + self.interval
+        return int(tick)
+
+
+class AdaptiveInterval(object):
+    """Poll period for one slow device, from how it's been answering."""
+
+    def __init__(self, interval, maximum, budget=None, window=None):
+        self.tick = interval
+        self.maximum = maximum
+        self.budget = budget or BUDGET
+        self.latencies = collections.deque(maxlen=window or WINDOW)
+        self.failures = 0
+        self.interval = interval
+        self.last_poll = None
+
+    def due(self, ts):
+        """Returns True, and counts the poll as started, if a poll is due
+        at tick ts.
+        """
+
+        if self.last_poll is not None and ts - self.last_poll < self.interval:
+            return False
+        self.last_poll = ts
+        return True
+
+    def success(self, latency):
+        """Records a poll that was answered in latency seconds."""
+
+        self.failures = 0
+        self.latencies.append(latency)
+        self.update()
+
+    def failure(self):
+        """Records a poll that failed or timed out."""
+
+        # past the maximum another doubling changes nothing, and a device
+        # that stays down for days would overflow 2 ** failures
+        if self.interval < self.maximum:
+            self.failures += 1
+        self.update()
+
+    def update(self):
+        interval = float(self.tick)
+        if self.latencies:
+            mean = sum(self.latencies) / len(self.latencies)
+            interval = max(interval, mean / self.budget)
+        interval *= 2 ** self.failures
+        # polls only start on ticks, so that's the period we really get
+        ticks = int(math.ceil(interval / self.tick))
+        self.interval = min(self.maximum, ticks * self.tick)
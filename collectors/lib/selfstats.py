@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# vim: syntax=python:expandtab:shiftwidth=4:softtabstop=4:tabstop=4
+
+"""Self-instrumentation for the collectors
+
+Each collector keeps a SelfStats, times the phases of its cycle with it and
+counts its errors, and sends the lot once per cycle as tcollector.self.*,
+tagged with collector=<name>:
+
+    self_stats = selfstats.SelfStats('smartctl_stat')
+
+    def collect(out, ts):
+        with self_stats.phase('smartctl'):
+            results = run_all(...)
+        ...
+        self_stats.error()
+
+    sched = scheduler.Scheduler(INTERVAL)
+    for ts in sched:
+        with self_stats.cycle():
+            collect(out, ts)
+        self_stats.report(out, ts, sched.missed)
+        with self_stats.phase('flush'):
+            out.flush()
+
+Metrics sent by report():
+
+tcollector.self.cycle_time_s   seconds the last cycle took
+tcollector.self.phase_time_s   seconds spent in each phase, tagged phase=;
+                               flush time shows up in the next cycle's
+tcollector.self.points         points emitted this cycle, not counting
+                               these
+tcollector.self.errors         errors counted since startup
+tcollector.self.overruns       ticks skipped because a cycle ran long
+tcollector.self.counter_resets counter resets seen deriving rates, when
+                               the Emitter has rates
+tcollector.self.rss_bytes      resident memory of the process
+tcollector.self.spool_*        spool depth in bytes and points, and points
+                               dropped, when the Emitter spools
+tcollector.self.tsd_*          bytes held and points dropped for TSDs that
+                               are down, connections open and connects
+                               made, when the Emitter sends to TSDs itself
+tcollector.self.<name>         anything else counted with count() or
+                               set()
+
+Phases should only be timed from the thread running the cycle; error()
+and count() may be called from any thread.
+"""
+
+import contextlib
+import os
+import resource
+import threading
+import time
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def rss_bytes():
+    """Returns this process's resident set size, or its peak where there's
+    no /proc to ask.
+    """
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (IOError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SelfStats(object):
+    """Phase timers and counters for one collector."""
+
+    def __init__(self, collector):
+        self.tags = {'collector': collector}
+        self.lock = threading.Lock()
+        # phase -> seconds spent in it this cycle
+        self.phases = {}
+        # name -> count since startup
+        self.counters = {'errors': 0}
+        self.cycle_time = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Adds the time spent in the with block to phase name."""
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    @contextlib.contextmanager
+    def cycle(self):
+        """Times a whole cycle."""
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.cycle_time = time.time() - start
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def error(self, n=1):
+        self.count('errors', n)
+
+    def report(self, out, ts, missed=None, process=True):
+        """Emits this cycle's stats into out and starts the next cycle.
+        missed is the Scheduler's count of skipped ticks. process=False
+        leaves out the RSS and output spool, for collectors sharing a
+        process.
+        """
+
+        points = len(out.buffer)
+        phases, self.phases = self.phases, {}
+        with self.lock:
+            counters = self.counters.items()
+
+        tags = self.tags
+        if self.cycle_time is not None:
+            out.emit('tcollector.self.cycle_time_s', ts, self.cycle_time,
+                     tags, '%.3f')
+        for name, elapsed in phases.iteritems():
+            out.emit('tcollector.self.phase_time_s', ts, elapsed,
+                     dict(tags, phase=name), '%.3f')
+        out.emit('tcollector.self.points', ts, points, tags)
+        for name, value in counters:
+            out.emit('tcollector.self.' + name, ts, value, tags)
+        if missed is not None:
+            out.emit('tcollector.self.overruns', ts, missed, tags)
+        if out.rates is not None:
+            out.emit('tcollector.self.counter_resets', ts, out.rates.resets,
+                     tags)
+        if process:
+            out.emit('tcollector.self.rss_bytes', ts, rss_bytes(), tags)
+            metrics = getattr(out.sink, 'metrics', None)
+            if metrics is not None:
+                for name, value in metrics():
+                    out.emit('tcollector.self.' + name, ts, value, tags)
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+"""Checks the Emitter's tsd= sink against TSD stand-ins listening on
+127.0.0.1.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from collectors.lib import emitter
+
+# how long to wait for lines to turn up at a listener
+WAIT = 5
+
+
+def free_port():
+    """Returns a port nothing is listening on, for an endpoint that's
+    down until a Listener is started on it.
+    """
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Listener(object):
+    """A TSD that accepts connections and keeps the lines sent to it."""
+
+    def __init__(self, port=0):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(5)
+        self.endpoint = '127.0.0.1:%d' % self.sock.getsockname()[1]
+        self.data = []
+        self.lock = threading.Lock()
+        self.clients = []
+        accept = threading.Thread(target=self.accept)
+        accept.daemon = True
+        accept.start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.clients.append(client)
+            reader = threading.Thread(target=self.read, args=(client,))
+            reader.daemon = True
+            reader.start()
+
+    def read(self, client):
+        while True:
+            try:
+                data = client.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            with self.lock:
+                self.data.append(data)
+
+    def lines(self):
+        with self.lock:
+            return ''.join(self.data).splitlines()
+
+    def wait(self, count):
+        """Returns the lines received once there are count of them."""
+
+        deadline = time.time() + WAIT
+        while len(self.lines()) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.lines()
+
+    def close(self):
+        self.sock.close()
+        for client in self.clients:
+            client.close()
+
+
+class TSDSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (emitter.TSD_BACKOFF_MIN, emitter.TSD_PENDING)
+        emitter.TSD_BACKOFF_MIN = 0.05
+        self.listeners = []
+        self.host = ' host=' + socket.gethostname()
+
+    def tearDown(self):
+        emitter.TSD_BACKOFF_MIN, emitter.TSD_PENDING = self.saved
+        for listener in self.listeners:
+            listener.close()
+
+    def listen(self, port=0):
+        listener = Listener(port)
+        self.listeners.append(listener)
+        return listener
+
+    def connection(self, out):
+        return out.sink.connections[0]
+
+    def retry(self, out):
+        """Waits out the backoff of a down endpoint and drains to it."""
+
+        connection = self.connection(out)
+        time.sleep(max(0, connection.next_attempt - time.time()) + 0.01)
+        out.flush()
+
+    def test_sharding_stable(self):
+        listeners = [self.listen() for _ in range(3)]
+        out = emitter.Emitter(tsd=[l.endpoint for l in listeners])
+        for ts in range(1000, 1004):
+            for i in range(30):
+                out.emit('test.metric', ts, i, {'series': i})
+            out.flush()
+
+        deadline = time.time() + WAIT
+        while (sum(len(l.lines()) for l in listeners) < 120 and
+               time.time() < deadline):
+            time.sleep(0.01)
+
+        # every series sticks to one endpoint, and all points arrive
+        shards = {}
+        total = 0
+        for index, listener in enumerate(listeners):
+            lines = listener.lines()
+            self.assertTrue(lines, "nothing sent to shard %d" % index)
+            for line in lines:
+                command, metric, ts, value, tags = line.split(' ', 4)
+                self.assertEqual(command, 'put')
+                shards.setdefault(tags, set()).add(index)
+            total += len(lines)
+        self.assertEqual(total, 120)
+        self.assertEqual(len(shards), 30)
+        for tags, indexes in shards.iteritems():
+            self.assertEqual(len(indexes), 1, tags)
+
+    def test_down_endpoint_retried(self):
+        port = free_port()
+        out = emitter.Emitter(tsd=['127.0.0.1:%d' % port])
+        for ts in range(1000, 1003):
+            out.emit('test.metric', ts, ts - 1000)
+            out.flush()
+        metrics = dict(out.sink.metrics())
+        self.assertEqual(metrics['tsd_connected'], 0)
+        self.assertTrue(metrics['tsd_pending_bytes'] > 0)
+
+        listener = self.listen(port)
+        self.retry(out)
+        out.emit('test.metric', 1003, 3)
+        out.flush()
+
+        self.assertEqual(listener.wait(4), [
+            'put test.metric 1000 0' + self.host,
+            'put test.metric 1001 1' + self.host,
+            'put test.metric 1002 2' + self.host,
+            'put test.metric 1003 3' + self.host,
+        ])
+        metrics = dict(out.sink.metrics())
+        self.assertEqual(metrics['tsd_pending_bytes'], 0)
+        self.assertEqual(metrics['tsd_dropped'], 0)
+        self.assertEqual(metrics['tsd_connected'], 1)
+        self.assertEqual(metrics['tsd_connects'], 1)
+
+    def test_pending_overflow_dropped(self):
+        line = 'put test.metric 1000 0' + self.host + '\n'
+        emitter.TSD_PENDING = len(line) * 3
+        port = free_port()
+        out = emitter.Emitter(tsd=['127.0.0.1:%d' % port])
+        for ts in range(1000, 1010):
+            out.emit('test.metric', ts, ts - 1000)
+            out.flush()
+
+        metrics = dict(out.sink.metrics())
+        self.assertEqual(metrics['tsd_dropped'], 7)
+        self.assertEqual(metrics['tsd_pending_bytes'], len(line) * 3)
+
+        # the newest batches survive, in order
+        listener = self.listen(port)
+        self.retry(out)
+        self.assertEqual(listener.wait(3), [
+            'put test.metric 1007 7' + self.host,
+            'put test.metric 1008 8' + self.host,
+            'put test.metric 1009 9' + self.host,
+        ])
+        self.assertEqual(dict(out.sink.metrics())['tsd_dropped'], 7)
+
+    def test_host_tag(self):
+        listener = self.listen()
+        out = emitter.Emitter(tsd=[listener.endpoint])
+        out.emit('test.untagged', 1000, 1)
+        out.emit('test.tagged', 1000, 2, {'device': 'sda'})
+        out.emit('test.own_host', 1000, 3, {'host': 'modem'})
+        out.flush()
+        self.assertEqual(listener.wait(3), [
+            'put test.untagged 1000 1' + self.host,
+            'put test.tagged 1000 2 device=sda' + self.host,
+            'put test.own_host 1000 3 host=modem',
+        ])
+
+    def test_configured_tags(self):
+        listener = self.listen()
+        out = emitter.Emitter(tsd=[listener.endpoint],
+                              tsd_tags={'host': 'pi', 'site': 'barn'})
+        out.emit('test.untagged', 1000, 1)
+        out.emit('test.tagged', 1000, 2, {'site': 'attic'})
+        out.flush()
+        self.assertEqual(listener.wait(2), [
+            'put test.untagged 1000 1 host=pi site=barn',
+            'put test.tagged 1000 2 site=attic host=pi',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+"""Checks AdaptiveInterval's backoff.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from collectors.lib import scheduler
+
+
+class AdaptiveIntervalTest(unittest.TestCase):
+
+    def test_failures_double_up_to_maximum(self):
+        poll = scheduler.AdaptiveInterval(15, maximum=300)
+        intervals = []
+        for _ in range(6):
+            poll.failure()
+            intervals.append(poll.interval)
+        self.assertEqual(intervals, [30, 60, 120, 240, 300, 300])
+
+    def test_down_for_days(self):
+        poll = scheduler.AdaptiveInterval(15, maximum=300, budget=0.5)
+        poll.success(1.0)
+        for _ in range(1100):
+            poll.failure()
+        self.assertEqual(poll.interval, 300)
+        self.assertTrue(poll.failures < 10)
+
+        # one answer and it's back to its own pace
+        poll.success(1.0)
+        self.assertEqual(poll.interval, 15)
+
+    def test_latency_stretches_interval(self):
+        poll = scheduler.AdaptiveInterval(10, maximum=600, budget=0.1)
+        poll.success(2.5)
+        self.assertEqual(poll.interval, 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
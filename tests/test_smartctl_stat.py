@@ -0,0 +1,193 @@
+#!/usr/bin/python
+"""Checks smartctl_stat's parsers and collect() against the captures in
+bench/data/smartctl.
+
+    python -m unittest discover -s tests
+"""
+
+import glob
+import imp
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+DATA = os.path.join(ROOT, 'bench', 'data', 'smartctl')
+
+smartctl_stat = imp.load_source(
+    'smartctl_stat', os.path.join(ROOT, 'collectors', '0', 'smartctl_stat.py'))
+
+
+def read_capture(name):
+    return open(os.path.join(DATA, name)).read()
+
+
+def attributes(parsed):
+    """Maps name to (raw, normalized, threshold) for parser output."""
+
+    result = {}
+    for name, raw, normalized, threshold in parsed:
+        result[name] = (raw, normalized, threshold)
+    return result
+
+
+class FakeEmitter(object):
+
+    def __init__(self):
+        self.points = []
+
+    def emit(self, metric, ts, value, tags=None):
+        self.points.append((metric, value, tags))
+
+    def values(self, metric):
+        return [value for name, value, _ in self.points if name == metric]
+
+
+class ParseTextTest(unittest.TestCase):
+
+    def setUp(self):
+        smartctl_stat.layouts.clear()
+        self.attributes = attributes(smartctl_stat.parse_text(
+            read_capture('ata-ST4000DM000.txt')))
+
+    def test_names(self):
+        self.assertEqual(len(self.attributes), 24)
+        self.assertTrue('raw_read_error_rate' in self.attributes)
+        self.assertTrue('end-to-end_error' in self.attributes)
+        self.assertTrue('total_lbas_read' in self.attributes)
+
+    def test_values(self):
+        self.assertEqual(self.attributes['raw_read_error_rate'],
+                         (154319272, 117, 6))
+        self.assertEqual(self.attributes['spin_retry_count'], (0, 100, 97))
+        self.assertEqual(self.attributes['total_lbas_read'],
+                         (198478418571, 100, 0))
+
+    def test_raw_value_with_spaces(self):
+        self.assertEqual(self.attributes['airflow_temperature_cel'],
+                         (34, 66, 45))
+        self.assertEqual(self.attributes['temperature_celsius'][0], 34)
+        self.assertEqual(self.attributes['command_timeout'][0], 0)
+        self.assertEqual(self.attributes['head_flying_hours'][0], 26297)
+
+    def test_layout_cached_by_model(self):
+        self.assertEqual(smartctl_stat.layouts.keys(), ['ST4000DM000-1F2168'])
+
+    def test_no_attributes(self):
+        for name in ('standby.txt', 'no-json.txt'):
+            self.assertEqual(
+                list(smartctl_stat.parse_text(read_capture(name))), [])
+
+
+class ParseJsonTest(unittest.TestCase):
+
+    def test_ata(self):
+        parsed = attributes(smartctl_stat.parse_json(
+            read_capture('ata-WDC-WD30EFRX.json')))
+        self.assertEqual(len(parsed), 10)
+        self.assertEqual(parsed['power_on_hours'], (44719, 39, 0))
+        self.assertEqual(parsed['reallocated_sector_ct'], (0, 200, 140))
+        self.assertEqual(parsed['temperature_celsius'], (32, 118, 0))
+
+    def test_nvme(self):
+        parsed = attributes(smartctl_stat.parse_json(
+            read_capture('nvme-Samsung-970.json')))
+        self.assertEqual(parsed['temperature'], (38, None, None))
+        self.assertEqual(parsed['num_err_log_entries'], (712, None, None))
+        self.assertEqual(parsed['data_units_written'][0], 23890453)
+        # lists aren't counters
+        self.assertFalse('temperature_sensors' in parsed)
+
+    def test_standby(self):
+        self.assertEqual(
+            list(smartctl_stat.parse_json(read_capture('standby.json'))), [])
+
+    def test_not_json(self):
+        self.assertRaises(ValueError, list, smartctl_stat.parse_json(
+            read_capture('no-json.txt')))
+
+
+class ParseSmartctlTest(unittest.TestCase):
+
+    def test_picks_parser(self):
+        for name in ('ata-ST4000DM000.txt', 'ata-WDC-WD30EFRX.json',
+                     'nvme-Samsung-970.json'):
+            stdout = read_capture(name)
+            if name.endswith('.json'):
+                expected = smartctl_stat.parse_json(stdout)
+            else:
+                expected = smartctl_stat.parse_text(stdout)
+            self.assertEqual(list(smartctl_stat.parse_smartctl(stdout)),
+                             list(expected))
+
+
+class CollectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (smartctl_stat.discover_devices,
+                      smartctl_stat.run_smartctl)
+        smartctl_stat.USE_JSON = True
+        smartctl_stat.devices = []
+        smartctl_stat.layouts.clear()
+
+    def tearDown(self):
+        (smartctl_stat.discover_devices,
+         smartctl_stat.run_smartctl) = self.saved
+        smartctl_stat.USE_JSON = True
+
+    def collect(self, captures):
+        smartctl_stat.discover_devices = lambda: sorted(captures)
+        smartctl_stat.run_smartctl = captures.__getitem__
+        out = FakeEmitter()
+        smartctl_stat.collect(out, 1000)
+        return out
+
+    def test_standby(self):
+        out = self.collect({
+            '/dev/sdb': (2, read_capture('standby.json')),
+            '/dev/sdc': (2, read_capture('standby.txt')),
+        })
+        self.assertEqual(out.values('smart.smartctl.devices'), [2])
+        self.assertEqual(out.values('smart.smartctl.devices_standby'), [2])
+        self.assertEqual(out.values('smart.smartctl.devices_failed'), [0])
+        self.assertEqual(len(out.points), 3)
+
+    def test_no_json(self):
+        out = self.collect({'/dev/sda': (1, read_capture('no-json.txt'))})
+        self.assertEqual(out.values('smart.smartctl.devices_failed'), [1])
+        self.assertFalse(smartctl_stat.USE_JSON)
+
+    def test_all_captures(self):
+        captures = {}
+        for path in glob.glob(os.path.join(DATA, '*')):
+            name = os.path.basename(path)
+            returncode = 0
+            if name.startswith('standby'):
+                returncode = 2
+            elif name.startswith('no-json'):
+                returncode = 1
+            captures['/dev/disk/by-id/' + name] = (returncode,
+                                                   read_capture(name))
+        out = self.collect(captures)
+        self.assertEqual(out.values('smart.smartctl.devices'), [6])
+        self.assertEqual(out.values('smart.smartctl.devices_standby'), [2])
+        self.assertEqual(out.values('smart.smartctl.devices_failed'), [1])
+
+        tags = {'device': 'disk_by-id_ata-ST4000DM000.txt'}
+        self.assertTrue(('smart.smartctl.airflow_temperature_cel', 34, tags)
+                        in out.points)
+        self.assertTrue(('smart.smartctl.airflow_temperature_cel.normalized',
+                         66, tags) in out.points)
+        self.assertTrue(('smart.smartctl.airflow_temperature_cel.threshold',
+                         45, tags) in out.points)
+        tags = {'device': 'disk_by-id_nvme-Samsung-970.json'}
+        self.assertTrue(('smart.smartctl.temperature', 38, tags)
+                        in out.points)
+        self.assertFalse(('smart.smartctl.temperature.normalized', None, tags)
+                         in out.points)
+
+
+if __name__ == '__main__':
+    unittest.main()